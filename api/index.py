@@ -1,15 +1,21 @@
+import os
+import hmac
+import asyncio
 import logging
 
-from flask import Flask, request, jsonify
+from quart import Quart, Response, request, jsonify
 from backend.dbp import (
-    get_profile,
-    save_message,
-    get_messages,
-    get_persona,
-    update_server_address,
+    aupdate_server_address,
+    conversation_cache,
+    invalidate_conversations,
 )
-from backend.llm import llm_call
-from backend.utils import sanitize_response
+from backend.conversations import inbox
+from backend import outbox
+from backend.responder import respond
+from backend.llm import memory_mode_stats, prompt_cache_stats
+from backend.jobs import get_queue, run_worker
+from backend.tracing import traced, configure_logging
+from backend import metrics
 from backend.messaging import Messaging, BlueBubbles, Telegram, Web
 
 BOTS: dict[str, Messaging] = {
@@ -18,64 +24,124 @@ BOTS: dict[str, Messaging] = {
     "web": Web(),
 }
 
+configure_logging()
 logging.getLogger("httpx").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = Quart(__name__)
+# refuse a body over the largest attachment up front, quart buffers it whole before parse sees it
+app.config["MAX_CONTENT_LENGTH"] = BOTS["web"].MAX_PHOTO_SIZE_BYTES + 64 * 1024
+
+
+def authorized(variable):
+    """Whether the request carries the secret held in an environment variable, never if it is unset."""
+    secret = os.environ.get(variable)
+    header = request.headers.get("Authorization", "")
+    return bool(secret) and hmac.compare_digest(header, f"Bearer {secret}")
 
 
 @app.route("/api/responder", methods=["GET", "POST"])
-def responder():
+@traced("responder")
+async def responder():
     # get correct bot
     channel = request.args.get("channel")
     if channel not in BOTS:
         return jsonify({"status": 400, "message": "Invalid channel"})
     bot = BOTS[channel]
 
-    # parse and sanitize request
-    error, user_id, chat_id, message, attachment_data = bot.parse(request)
-    print(error, user_id, chat_id, message, attachment_data)
-    if error:
-        return jsonify({"status": 400, "message": error})
+    # acknowledge webhooks as soon as the event is stored, so a slow reply never gets it
+    # redelivered, and a failed store does
+    if bot.webhook:
+        event = await request.get_json()
+        if (event_id := bot.event_id(event)) is None:
+            return jsonify({"status": 400, "message": "Missing event id"})
+        if not await inbox.submit(
+            channel, event_id, event, lambda: respond(bot, channel, event)
+        ):
+            return jsonify({"status": 200, "message": "duplicate"})
+        return jsonify({"status": 200, "message": "accepted"})
+
+    # the web channel waits for its reply, streamed as server sent events if asked
+    result = await respond(
+        bot, channel, request, stream=bool(request.args.get("stream"))
+    )
+    if isinstance(result, dict):
+        return jsonify(result)
+    return Response(result, mimetype="text/event-stream")
 
-    # send typing indicator
-    bot.send_typing_indicator(chat_id)
 
-    # get user profile
-    profile = get_profile(channel, user_id)
+@app.after_serving
+async def drain():
+    # finish replying to every event already acknowledged, and deliver the replies
+    await inbox.join()
+    await outbox.join()
 
-    # get persona
-    persona = get_persona(channel, profile["id"], chat_id)
 
-    # save user message
-    save_message(
-        profile["id"], persona["id"], channel, "user", message, attachment_data
-    )
+@app.route("/api/url_updater", methods=["GET", "POST"])
+async def url_updater():
+    if server_url := (await request.get_json()).get("data", ""):
+        await aupdate_server_address(server_url)
+        return jsonify({"status": 200})
+
+    return jsonify({"status": 400})
+
 
-    # call llm
-    response = llm_call(
-        persona,
-        profile["id"],
-        persona["id"],
-        get_messages(profile["id"], persona["id"], channel),
+@app.route("/api/memory_worker", methods=["GET", "POST"])
+async def memory_worker():
+    # only the scheduler may drain the queue
+    if not authorized("CRON_SECRET"):
+        return jsonify({"status": 401})
+
+    # consolidation is blocking, keep it off the event loop
+    processed = await asyncio.to_thread(
+        run_worker, max_jobs=int(request.args.get("max_jobs", 5))
     )
+    depth = await asyncio.to_thread(get_queue().depth)
+    return jsonify({"status": 200, "processed": processed, "depth": depth})
 
-    # parse the response
-    response = sanitize_response(response)
 
-    # send the response
-    bot.send_message(chat_id, response)
-    save_message(profile["id"], persona["id"], channel, "assistant", response)
+@app.route("/api/inbound_worker", methods=["GET", "POST"])
+async def inbound_worker():
+    # only the scheduler may answer stored events
+    if not authorized("CRON_SECRET"):
+        return jsonify({"status": 401})
 
-    # for the web channel
-    return jsonify(
-        {"status": 200, "message": {"role": "assistant", "content": response}}
+    # events whose instance died or was frozen before answering them, or whose answer failed
+    processed = await inbox.run_pending(
+        lambda channel, event: respond(BOTS[channel], channel, event),
+        max_events=int(request.args.get("max_events", 10)),
     )
+    return jsonify({"status": 200, "processed": processed})
 
 
-@app.route("/api/url_updater", methods=["GET", "POST"])
-def url_updater():
-    if server_url := request.json.get("data", ""):
-        update_server_address(server_url)
-        return jsonify({"status": 200})
+@app.route("/api/cache", methods=["GET", "POST"])
+async def cache():
+    # only the web app (which shares the service role key) may touch the cache
+    if not authorized("SUPABASE_SERVICE_ROLE_KEY"):
+        return jsonify({"status": 401})
 
-    return jsonify({"status": 400})
+    # each instance holds its own cache, the ttl bounds staleness on the others
+    if request.method == "POST":
+        invalidate_conversations((await request.get_json()).get("profile_id"))
+    return jsonify({"status": 200, "conversations": conversation_cache.stats()})
+
+
+@app.route("/api/metrics", methods=["GET"])
+async def get_metrics():
+    # ?format=prometheus for a scraper, json otherwise
+    if request.args.get("format") == "prometheus":
+        return Response(metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+    return jsonify(
+        {
+            "status": 200,
+            "counters": metrics.snapshot(),
+            "latencies": metrics.histograms(),
+            "memory_modes": memory_mode_stats(),
+            "prompt_cache": prompt_cache_stats(),
+            "outbox": {
+                channel: bot.outbox.depth()
+                for channel, bot in BOTS.items()
+                if bot.outbox is not None
+            },
+        }
+    )
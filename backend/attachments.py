@@ -0,0 +1,112 @@
+import io
+import os
+import asyncio
+import hashlib
+import tempfile
+import contextlib
+
+from backend import metrics
+from backend.utils import TTLCache
+from backend.tracing import span
+
+# longest side of an image sent to the vision model
+VISION_MAX_SIDE = 1024
+# images smaller than this are described as they are, re-encoding them saves too little
+VISION_MAX_BYTES = 512 * 1024
+
+# content hash -> description, the attachments table behind it is shared by every instance
+description_cache = TTLCache(maxsize=2048, ttl=24 * 60 * 60)
+
+
+class AttachmentTooLarge(Exception):
+    """Raised when a download passes the size cap, before the rest of it is read"""
+
+
+async def spool(chunks, name, mime_type, max_bytes):
+    """Write an async stream of chunks to a temporary file and return it as an attachment.
+
+    Attachments are {"name", "path", "size", "mime_type"} and are read back from
+    the file, so a request never holds more than one chunk of the download at once.
+    """
+    f = tempfile.NamedTemporaryFile(prefix="attachment-", delete=False)
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise AttachmentTooLarge(f"{name} is over {max_bytes} bytes")
+            f.write(chunk)
+    except BaseException:
+        f.close()
+        os.unlink(f.name)
+        raise
+    f.close()
+    return {"name": name, "path": f.name, "size": size, "mime_type": mime_type}
+
+
+def discard(attachment):
+    """Delete an attachment's spooled file once the message is saved."""
+    if attachment:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(attachment["path"])
+
+
+def content_hash(attachment):
+    with open(attachment["path"], "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def vision_payload(attachment):
+    """Return the (data, mime_type) to show the vision model, a large image is scaled down first."""
+    path, mime_type = attachment["path"], attachment["mime_type"]
+    if attachment["size"] > VISION_MAX_BYTES and mime_type.startswith("image/"):
+        try:
+            from PIL import Image
+
+            with Image.open(path) as image:
+                image.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE))
+                out = io.BytesIO()
+                image.convert("RGB").save(out, format="JPEG", quality=85, optimize=True)
+            if out.tell() < attachment["size"]:
+                metrics.incr("vision_bytes_saved", attachment["size"] - out.tell())
+                return out.getvalue(), "image/jpeg"
+        except Exception:
+            # no pillow or a format it can't read, the model gets the original
+            pass
+    with open(path, "rb") as f:
+        return f.read(), mime_type
+
+
+async def aprocess_attachment(user_id, persona_id, attachment):
+    """Return (file_path, description) for an attachment, only uploading and describing content that is new."""
+    from backend.dbp import aget_attachments, asave_attachment, aupload_attachment
+    from backend.llm import aget_attachment_description
+
+    digest = await asyncio.to_thread(content_hash, attachment)
+    seen = await aget_attachments(digest)
+
+    # stored files are private to their user, but a description fits anyone who sends the same bytes
+    file_path = next((r["file_path"] for r in seen if r["user_id"] == user_id), None)
+    description = description_cache.get(digest) or next(
+        (r["description"] for r in seen if r["description"]), None
+    )
+    metrics.incr("attachments", upload="skipped" if file_path else "new")
+    metrics.incr("attachments", vision="cached" if description else "new")
+    if file_path and description:
+        return file_path, description
+
+    async def upload():
+        return file_path or await aupload_attachment(user_id, persona_id, attachment)
+
+    async def describe():
+        if description:
+            return description
+        with span("vision_payload", bytes=attachment["size"]) as s:
+            data, mime_type = await asyncio.to_thread(vision_payload, attachment)
+            s.set(payload_bytes=len(data))
+        return await aget_attachment_description(data, mime_type)
+
+    file_path, description = await asyncio.gather(upload(), describe())
+    description_cache.set(digest, description)
+    await asave_attachment(digest, user_id, file_path, description)
+    return file_path, description
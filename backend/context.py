@@ -0,0 +1,145 @@
+import os
+import re
+import json
+from functools import lru_cache
+
+from backend import metrics
+from backend.tracing import current
+from backend.utils import parse_time
+
+# prompt tokens a reply may spend on the persona, its memories and the history combined
+TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 4000))
+# how many rows of history to fetch at most, the budget decides how many are used
+MAX_HISTORY = int(os.environ.get("CONTEXT_MAX_MESSAGES", 60))
+# turns kept verbatim even when the summary already covers them, for continuity
+RECENT_TURNS = int(os.environ.get("CONTEXT_RECENT_TURNS", 6))
+# the only message columns the prompt is built from
+HISTORY_COLUMNS = "role,content,file_description,created_at"
+# the role markers and separators a chat template wraps around every message
+MESSAGE_OVERHEAD = 4
+# characters per token by model family, for when tiktoken isn't installed
+CHARS_PER_TOKEN = {"openai": 4.0, "google": 4.0, "anthropic": 3.5}
+# families that only cache a prompt prefix at explicit cache_control breakpoints,
+# the rest (openai, deepseek, grok, ...) cache the longest repeated prefix on their own
+CACHE_CONTROL_FAMILIES = ("anthropic/", "google/gemini")
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    if re.match(r"openai/(gpt-4o|gpt-4\.1|gpt-5|o\d)", model):
+        return tiktoken.get_encoding("o200k_base")
+    # not the model's own tokenizer, but a far closer estimate than a character ratio
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(model, text):
+    """Count the tokens text costs with model, using tiktoken if it is installed."""
+    if not text:
+        return 0
+    if (encoding := _encoding(model)) is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return int(len(text) / CHARS_PER_TOKEN.get(model.split("/")[0], 3.8)) + 1
+
+
+def message_tokens(model, message):
+    return count_tokens(model, message["content"]) + MESSAGE_OVERHEAD
+
+
+def to_turn(m):
+    content = m["content"] or ""
+    # describe images inline instead of spending a whole system message on each
+    if m.get("file_description"):
+        content += f"\n(The user sent you an image: {m['file_description']})"
+    return {"role": m["role"], "content": content}
+
+
+def fit_history(model, msgs, budget):
+    """Keep the newest turns that fit in budget tokens, always keeping the latest one."""
+    kept, used = [], 0
+    for m in reversed(msgs):
+        turn = to_turn(m)
+        cost = message_tokens(model, turn)
+        if kept and used + cost > budget:
+            break
+        kept.append(turn)
+        used += cost
+    return kept[::-1], len(msgs) - len(kept), used
+
+
+def merge_turns(turns):
+    """Join consecutive turns from the same role, so a burst of texts reads as one turn."""
+    merged = []
+    for turn in turns:
+        if merged and merged[-1]["role"] == turn["role"]:
+            merged[-1] = {
+                "role": turn["role"],
+                "content": merged[-1]["content"] + "\n" + turn["content"],
+            }
+        else:
+            merged.append(turn)
+    return merged
+
+
+def unsummarized(msgs, summary):
+    """The turns the summary doesn't cover, and at least the last RECENT_TURNS."""
+    through = parse_time(summary["summarized_through"])
+    newer = sum(1 for m in msgs if parse_time(m["created_at"]) > through)
+    return msgs[-max(newer, RECENT_TURNS) :]
+
+
+def mark_cache_breakpoint(model, message):
+    """Mark the end of message as a cache breakpoint, if the model needs it spelled out."""
+    if not model.startswith(CACHE_CONTROL_FAMILIES):
+        return message
+    return {
+        "role": message["role"],
+        "content": [
+            {
+                "type": "text",
+                "text": message["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+    }
+
+
+def build_context(persona, msgs, facts=None, summary=None, budget=TOKEN_BUDGET):
+    """Lay out the prompt for a reply, filling whatever the budget leaves after the persona, summary and memories with history."""
+    model = persona["model"]
+    system = [{"role": "system", "content": persona["prompt"]}]
+    if summary:
+        system.append(
+            {
+                "role": "system",
+                "content": f"Here is a summary of your conversation so far: \n {summary['summary']}",
+            }
+        )
+        msgs = unsummarized(msgs, summary)
+    memories = []
+    if facts and (facts["facts_about_user"] or facts["facts_about_you"]):
+        memories.append(
+            {
+                "role": "system",
+                "content": f"Here is what you remember that may be relevant to the conversation: \n {json.dumps(facts)}",
+            }
+        )
+    fixed = sum(message_tokens(model, m) for m in system + memories)
+    history, dropped, used = fit_history(model, msgs, budget - fixed)
+    history = merge_turns(history)
+
+    # the tools, persona prompt and summary form a prefix that only changes when the
+    # summary does, so cache up to the prompt (never changes) and up to the summary
+    system = [mark_cache_breakpoint(model, m) for m in system]
+
+    metrics.incr("context_dropped_turns", dropped)
+    if s := current():
+        s.set(
+            history_turns=len(history),
+            dropped_turns=dropped,
+            prompt_tokens_estimate=fixed + used,
+        )
+    return system + history + memories
@@ -0,0 +1,237 @@
+import os
+import uuid
+import asyncio
+import logging
+from contextlib import asynccontextmanager, AsyncExitStack
+
+from backend import metrics
+from backend.utils import KeyedLock
+from backend.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+def shared():
+    """Whether conversations are coordinated across workers through Postgres."""
+    return os.environ.get("CONVERSATION_LOCK") == "supabase"
+
+
+# seconds to wait for a follow-up text before replying to a burst of them, every
+# imessage and telegram reply is delayed by this much, 0 turns coalescing off
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 1))
+# seconds a worker may hold a conversation before another one takes it over
+LEASE_SECONDS = int(os.environ.get("CONVERSATION_LEASE_SECONDS", 120))
+# seconds an inbound event may take to be answered before a worker retries it
+INBOUND_LEASE_SECONDS = int(os.environ.get("INBOUND_LEASE_SECONDS", 300))
+INBOUND_MAX_ATTEMPTS = 3
+INBOUND_BACKOFF_SECONDS = 30
+
+
+class Bursts:
+    """Coalesces rapid-fire messages in a conversation into one reply.
+
+    Every message is saved before it settles, so whichever message is the last
+    of its burst replies to all of them from the history. A message arriving
+    while a reply is generating cancels it, and the newer one answers instead.
+    With CONVERSATION_LOCK=supabase the generation is counted in Postgres, so
+    a burst spread over several workers still gets one reply. A reply already
+    underway on another worker isn't cancelled, the newer one follows it.
+
+    generation = await bursts.settle(key)
+    if generation is None:
+        return  # a newer message will reply
+    finished = await bursts.reply(key, generation, send_reply())
+    """
+
+    def __init__(self, window=COALESCE_WINDOW):
+        self.window = window
+        self._latest = {}
+        self._replies = {}
+
+    async def _bump(self, key):
+        if shared():
+            from backend.dbp import abump_conversation_generation
+
+            generation = await abump_conversation_generation(":".join(key))
+        else:
+            generation = self._latest.get(key, 0) + 1
+        # bumps can return out of order, never step back
+        self._latest[key] = max(self._latest.get(key, 0), generation)
+        return generation
+
+    async def _newest(self, key):
+        if shared():
+            from backend.dbp import aget_conversation_generation
+
+            return await aget_conversation_generation(":".join(key))
+        return self._latest.get(key)
+
+    async def settle(self, key):
+        """Wait out the window and return this message's generation, or None if a newer one arrived."""
+        generation = await self._bump(key)
+        if reply := self._replies.pop(key, None):
+            reply.cancel()
+            metrics.incr("coalesced", outcome="cancelled_reply")
+        await asyncio.sleep(self.window)
+        if await self._newest(key) != generation:
+            metrics.incr("coalesced", outcome="merged")
+            return None
+        return generation
+
+    async def reply(self, key, generation, coro):
+        """Run coro unless a newer message supersedes it, return False if it was cancelled."""
+        task = asyncio.ensure_future(coro)
+        # a newer message may have arrived while this one waited for its turn
+        if self._latest.get(key) != generation or await self._newest(key) != generation:
+            task.cancel()
+        else:
+            self._replies[key] = task
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if self._replies.get(key) is task:
+                del self._replies[key]
+            if self._latest.get(key) == generation:
+                del self._latest[key]
+        if task.cancelled():
+            return False
+        task.result()
+        return True
+
+
+bursts = Bursts()
+
+
+class Inbox:
+    """Answers inbound webhook events in the background, each event id once.
+
+    An event is stored in the inbound_events table before its webhook is
+    acknowledged, and the table's key drops anything Telegram or BlueBubbles
+    redeliver. The instance that stored it answers it right away under a lease.
+    If that instance dies or is frozen first, or the answer fails, a worker
+    calling run_pending() picks it up once the lease or a backoff runs out.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    async def submit(self, channel, event_id, event, process):
+        """Store an event and start process() on it, return False if it was stored before.
+
+        Raises if the event couldn't be stored, so the webhook fails and is redelivered.
+        """
+        from backend.dbp import aenqueue_inbound_event
+
+        key = (channel, str(event_id))
+        if not await aenqueue_inbound_event(*key, event, INBOUND_LEASE_SECONDS):
+            metrics.incr("inbound_events", outcome="duplicate")
+            return False
+        metrics.incr("inbound_events", outcome="accepted")
+        self.tasks[key] = asyncio.ensure_future(self._process(key, 1, process))
+        return True
+
+    async def run_pending(self, process, max_events=None):
+        """Answer stored events no one else is answering, return how many were processed.
+
+        process(channel, event) returns the coroutine that answers an event.
+        """
+        from backend.dbp import aclaim_inbound_event
+
+        processed = 0
+        while max_events is None or processed < max_events:
+            row = await aclaim_inbound_event(
+                INBOUND_LEASE_SECONDS, INBOUND_MAX_ATTEMPTS
+            )
+            if row is None:
+                break
+            key = (row["channel"], row["event_id"])
+            metrics.incr("inbound_events", outcome="recovered")
+            self.tasks[key] = task = asyncio.ensure_future(
+                self._process(
+                    key,
+                    row["attempts"],
+                    lambda: process(row["channel"], row["payload"]),
+                )
+            )
+            await task
+            processed += 1
+        return processed
+
+    async def _process(self, key, attempts, process):
+        from backend.dbp import aupdate_inbound_event
+
+        try:
+            update = await self._answer(key, attempts, process)
+            # if this fails too the lease runs out, and a worker answers the event again
+            await aupdate_inbound_event(*key, update)
+        except Exception as e:
+            logger.warning("Recording %s event %s failed: %s", *key, e)
+        finally:
+            self.tasks.pop(key, None)
+
+    @staticmethod
+    async def _answer(key, attempts, process):
+        """Run process() and return how to record the outcome, retrying failures with backoff."""
+        try:
+            with span("inbox.process", event=key[1], attempt=attempts):
+                await process()
+            return {"status": "done"}
+        except Exception as e:
+            logger.exception("Processing %s event %s failed", *key)
+            if attempts >= INBOUND_MAX_ATTEMPTS:
+                return {"status": "failed", "last_error": str(e)}
+            from backend.utils import now
+
+            backoff = INBOUND_BACKOFF_SECONDS * 2 ** (attempts - 1)
+            run_after = now().add(seconds=backoff).isoformat()
+            return {"status": "pending", "last_error": str(e), "run_after": run_after}
+
+    async def join(self, key=None):
+        """Wait for one event, or every event in flight, to finish processing."""
+        if key is not None:
+            if task := self.tasks.get((key[0], str(key[1]))):
+                await asyncio.shield(task)
+            return
+        while self.tasks:
+            await asyncio.gather(*self.tasks.values())
+
+
+inbox = Inbox()
+
+locks = KeyedLock()
+
+
+@asynccontextmanager
+async def lease(name):
+    """Hold a conversation across every worker through a lease row in Postgres."""
+    from backend.dbp import aacquire_conversation_lease, arelease_conversation_lease
+
+    holder, delay = str(uuid.uuid4()), 0.05
+    # an abandoned lease expires after LEASE_SECONDS, so this always ends
+    while not await aacquire_conversation_lease(name, holder, LEASE_SECONDS):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 1)
+    try:
+        yield
+    finally:
+        await arelease_conversation_lease(name, holder)
+
+
+@asynccontextmanager
+async def ordered(key):
+    """Run one reply at a time per conversation, so replies never interleave.
+
+    A texted reply lets go once its sentences are queued, and is saved after
+    they are delivered, so a reply started meanwhile may not see it yet.
+    Conversations never wait on each other. With CONVERSATION_LOCK=supabase the
+    order also holds across workers, otherwise only within this process.
+    """
+    async with AsyncExitStack() as stack:
+        with span("conversation.wait"):
+            await stack.enter_async_context(locks.hold(key))
+            if shared():
+                await stack.enter_async_context(lease(":".join(key)))
+        yield
@@ -5,78 +5,251 @@
 
 import os
 import uuid
-import requests
-from supabase import create_client, Client
+import asyncio
 
+from backend.utils import TTLCache, now
+from backend.tracing import traced
 
-supabase: Client = create_client(
-    os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
-)
+# clients are built on first use, importing supabase alone costs a cold start ~300ms
+_supabase = None
+_async_supabase = None
 _table_cache = {}
+_async_table_cache = {}
 
 CONTEXT_WINDOW = 30
+# a postgres connection string, if set the responder's hot queries skip postgrest, see backend.dbpg
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# (channel, address, persona id) -> (profile, persona), invalidated by the web app on edits
+conversation_cache = TTLCache(maxsize=4096, ttl=300)
+# the bluebubbles server url only moves when the server restarts, the ttl keeps workers in sync
+server_cache = TTLCache(maxsize=1, ttl=60)
+
+
+def get_client():
+    global _supabase
+    if _supabase is None:
+        from supabase import create_client
+
+        _supabase = create_client(
+            os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+        )
+    return _supabase
 
 
 def get_table(table_name):
     if table_name in _table_cache:
         return _table_cache[table_name]
-    tbl = supabase.table(table_name)
+    tbl = get_client().table(table_name)
     _table_cache[table_name] = tbl
     return tbl
 
 
-def get_profiles():
-    resp = get_table("profiles").select("*").execute()
-    return resp.data if resp and resp.data else []
-
+async def get_async_client():
+    global _async_supabase
+    if _async_supabase is None:
+        from supabase import acreate_client
 
-def get_profile(channel: str, user_id: str):
-    query = get_table("profiles").select("*")
-    if channel == "telegram":
-        query = query.eq("telegram_address", user_id)
-    elif channel == "imessage":
-        query = query.eq("imessage_address", user_id)
-    else:
-        query = query.eq("id", user_id)
-    resp = query.maybe_single().execute()
-    return resp.data if resp and resp.data else None
+        _async_supabase = await acreate_client(
+            os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+        )
+    return _async_supabase
 
 
-def get_profile_personas(profile_id: str):
-    resp = get_table("personas").select("*").eq("user_id", profile_id).execute()
-    return resp.data if resp and resp.data else []
+async def aget_table(table_name):
+    if table_name in _async_table_cache:
+        return _async_table_cache[table_name]
+    tbl = (await get_async_client()).table(table_name)
+    _async_table_cache[table_name] = tbl
+    return tbl
 
 
-def get_persona(channel: str, user_id: str, persona_id: str):
-    query = get_table("personas").select("*").eq("user_id", user_id)
-    if channel == "web":
-        query = query.eq("id", persona_id)
-    elif channel == "telegram":
-        query = query.eq("is_telegram_persona", True)
-    elif channel == "imessage":
-        query = query.eq("is_imessage_persona", True)
-    resp = query.maybe_single().execute()
-    return resp.data if resp and resp.data else None
+# query builders, shared where a query has both a sync and an async caller
 
 
-def get_messages(user_id: str, persona_id: str, channel: str, memorized: bool = None):
-    table_name = "messages" if persona_id != "new" else "anonymous_messages"
+def _messages_query(
+    table, user_id: str, persona_id: str, channel: str, memorized, columns, limit
+):
     query = (
-        get_table(table_name)
-        .select("*")
+        table.select(columns)
         .eq("user_id", user_id)
         .eq("persona_id", persona_id)
         .eq("channel", channel)
         .order("created_at", desc=True)
-        .limit(CONTEXT_WINDOW)
+        .limit(limit)
     )
     if memorized is not None:
         query = query.eq("memorized", memorized)
-    resp = query.execute()
+    return query
+
+
+def _message_row(user_id, persona_id, channel, role, content):
+    return {
+        "user_id": user_id,
+        "persona_id": persona_id,
+        "channel": channel,
+        "role": role,
+        "content": content,
+    }
+
+
+def _save_and_claim_params(message: dict):
+    params = {f"p_{column}": value for column, value in message.items()}
+    return {**params, "p_batch_size": CONTEXT_WINDOW}
+
+
+def _messages_table(persona_id: str):
+    return "messages" if persona_id != "new" else "anonymous_messages"
+
+
+def _attachment_path(user_id: str, persona_id: str, attachment: dict):
+    return f"{user_id}/{persona_id}/{uuid.uuid4()}.{attachment['name'].split('.')[-1]}"
+
+
+# sync calls, for the memory worker and the tools that run in threads
+
+
+@traced("db.get_messages_by_ids")
+def get_messages_by_ids(ids: list):
+    resp = get_table("messages").select("*").in_("id", ids).order("created_at").execute()
+    return resp.data if resp and resp.data else []
+
+
+def _summary_query(table, user_id: str, persona_id: str, channel: str):
+    return (
+        table.select("summary,summarized_through")
+        .eq("user_id", user_id)
+        .eq("persona_id", persona_id)
+        .eq("channel", channel)
+        .maybe_single()
+    )
+
+
+def get_summary(user_id: str, persona_id: str, channel: str):
+    table = get_table("conversation_summaries")
+    resp = _summary_query(table, user_id, persona_id, channel).execute()
+    return resp.data if resp and resp.data else None
+
+
+def save_summary(
+    user_id: str, persona_id: str, channel: str, summary: str, summarized_through: str
+):
+    get_table("conversation_summaries").upsert(
+        {
+            "user_id": user_id,
+            "persona_id": persona_id,
+            "channel": channel,
+            "summary": summary,
+            "summarized_through": summarized_through,
+            "updated_at": now().isoformat(),
+        },
+        on_conflict="user_id,persona_id,channel",
+    ).execute()
+
+
+def get_search_answer(key: str):
+    resp = (
+        get_table("search_cache")
+        .select("answer,expires_at")
+        .eq("key", key)
+        .gt("expires_at", now().isoformat())
+        .maybe_single()
+        .execute()
+    )
+    return resp.data if resp and resp.data else None
+
+
+def save_search_answer(key: str, answer: str, query_class: str, expires_at: str):
+    get_table("search_cache").upsert(
+        {
+            "key": key,
+            "answer": answer,
+            "query_class": query_class,
+            "expires_at": expires_at,
+        },
+        on_conflict="key",
+    ).execute()
+
+
+# async calls, for the responder
+
+
+@traced("db.resolve_conversation")
+async def aresolve_conversation(channel: str, address: str, persona_id: str):
+    """Return the (profile, persona) pair for an inbound message in a single round trip."""
+    key = (channel, address, persona_id if channel == "web" else None)
+    if (cached := conversation_cache.get(key)) is not None:
+        return cached
+    if DATABASE_URL:
+        from backend import dbpg
+
+        data = await dbpg.resolve_conversation(channel, address, key[2]) or {}
+    else:
+        client = await get_async_client()
+        resp = await client.rpc(
+            "resolve_conversation",
+            {"p_channel": channel, "p_address": address, "p_persona_id": key[2]},
+        ).execute()
+        data = resp.data if resp and resp.data else {}
+    profile, persona = data.get("profile"), data.get("persona")
+    if profile and persona:
+        conversation_cache.set(key, (profile, persona))
+    return profile, persona
+
+
+def invalidate_conversations(profile_id: str = None):
+    """Forget cached lookups for a profile, or for everyone if no profile is given."""
+    conversation_cache.invalidate(
+        (lambda key, value: value[0]["id"] == profile_id) if profile_id else None
+    )
+
+
+@traced("db.get_messages")
+async def aget_messages(
+    user_id: str,
+    persona_id: str,
+    channel: str,
+    memorized: bool = None,
+    columns: str = "*",
+    limit: int = CONTEXT_WINDOW,
+):
+    if DATABASE_URL:
+        from backend import dbpg
+
+        rows = await dbpg.get_messages(
+            _messages_table(persona_id),
+            user_id,
+            persona_id,
+            channel,
+            memorized,
+            columns,
+            limit,
+        )
+        return rows[::-1]
+    table = await aget_table(_messages_table(persona_id))
+    query = _messages_query(
+        table, user_id, persona_id, channel, memorized, columns, limit
+    )
+    resp = await query.execute()
     return resp.data[::-1] if resp and resp.data else []
 
 
-def save_message(
+@traced("db.get_summary")
+async def aget_summary(user_id: str, persona_id: str, channel: str):
+    # anonymous conversations are never consolidated, so never summarized
+    if persona_id == "new":
+        return None
+    if DATABASE_URL:
+        from backend import dbpg
+
+        return await dbpg.get_summary(user_id, persona_id, channel)
+    table = await aget_table("conversation_summaries")
+    resp = await _summary_query(table, user_id, persona_id, channel).execute()
+    return resp.data if resp and resp.data else None
+
+
+@traced("db.save_message")
+async def asave_message(
     user_id: str,
     persona_id: str,
     channel: str,
@@ -84,44 +257,198 @@ def save_message(
     content: str,
     attachment: dict = None,
 ):
-    table_name = "messages" if persona_id != "new" else "anonymous_messages"
-    message = {
-        "user_id": user_id,
-        "persona_id": persona_id,
-        "channel": channel,
-        "role": role,
-        "content": content,
-    }
+    table_name = _messages_table(persona_id)
+    message = _message_row(user_id, persona_id, channel, role, content)
     if attachment:
-        message["file_path"] = upload_attachment(user_id, persona_id, attachment)
-        from backend.llm import get_attachment_description
+        from backend.attachments import aprocess_attachment
+
+        message["file_path"], message["file_description"] = await aprocess_attachment(
+            user_id, persona_id, attachment
+        )
+    if role != "assistant" or persona_id == "new":
+        if DATABASE_URL:
+            from backend import dbpg
+
+            await dbpg.insert_message(table_name, message)
+        else:
+            await (await aget_table(table_name)).insert(message).execute()
+    elif ids := await asave_message_and_claim(message):
+        from backend.jobs import get_queue
+
+        try:
+            await asyncio.to_thread(
+                get_queue().enqueue, user_id, persona_id, channel, ids
+            )
+        except Exception:
+            if DATABASE_URL:
+                from backend import dbpg
+
+                await dbpg.release_batch(table_name, ids)
+            else:
+                table = await aget_table(table_name)
+                await table.update({"memorized": False}).in_("id", ids).execute()
+            raise
+
+
+@traced("db.save_message_and_claim")
+async def asave_message_and_claim(message: dict):
+    params = _save_and_claim_params(message)
+    if DATABASE_URL:
+        from backend import dbpg
+
+        return await dbpg.save_message_and_claim(params) or None
+    client = await get_async_client()
+    resp = await client.rpc("save_message_and_claim", params).execute()
+    return resp.data if resp and resp.data else None
+
+
+@traced("db.acquire_conversation_lease")
+async def aacquire_conversation_lease(key: str, holder: str, seconds: int):
+    """Take the lease on a conversation if it is free, expired or already ours."""
+    if DATABASE_URL:
+        from backend import dbpg
+
+        return bool(await dbpg.acquire_conversation_lease(key, holder, seconds))
+    client = await get_async_client()
+    resp = await client.rpc(
+        "acquire_conversation_lease",
+        {"p_key": key, "p_holder": holder, "p_seconds": seconds},
+    ).execute()
+    return bool(resp and resp.data)
+
+
+async def arelease_conversation_lease(key: str, holder: str):
+    if DATABASE_URL:
+        from backend import dbpg
+
+        await dbpg.release_conversation_lease(key, holder)
+    else:
+        client = await get_async_client()
+        await client.rpc(
+            "release_conversation_lease", {"p_key": key, "p_holder": holder}
+        ).execute()
+
+
+@traced("db.bump_conversation_generation")
+async def abump_conversation_generation(key: str):
+    """Count an inbound message on a conversation and return the count so far."""
+    if DATABASE_URL:
+        from backend import dbpg
+
+        return await dbpg.bump_conversation_generation(key)
+    client = await get_async_client()
+    resp = await client.rpc("bump_conversation_generation", {"p_key": key}).execute()
+    return resp.data
+
+
+@traced("db.get_conversation_generation")
+async def aget_conversation_generation(key: str):
+    if DATABASE_URL:
+        from backend import dbpg
+
+        return await dbpg.get_conversation_generation(key)
+    table = await aget_table("conversation_leases")
+    resp = await table.select("generation").eq("key", key).maybe_single().execute()
+    return resp.data["generation"] if resp and resp.data else 0
+
 
-        message["file_description"] = get_attachment_description(
-            attachment["bytes"], attachment["mime_type"]
+@traced("db.enqueue_inbound_event")
+async def aenqueue_inbound_event(
+    channel: str, event_id: str, payload: dict, lease_seconds: int
+):
+    """Store an inbound event leased to the caller, return False if it was stored before."""
+    if DATABASE_URL:
+        from backend import dbpg
+
+        return bool(
+            await dbpg.enqueue_inbound_event(channel, event_id, payload, lease_seconds)
         )
-    get_table(table_name).insert(message).execute()
-    if role == "assistant" and persona_id != "new":
-        unmemorized = get_messages(user_id, persona_id, channel, False)
-        if len(unmemorized) >= CONTEXT_WINDOW:
-            from backend.memory import processor
+    client = await get_async_client()
+    resp = await client.rpc(
+        "enqueue_inbound_event",
+        {
+            "p_channel": channel,
+            "p_event_id": event_id,
+            "p_payload": payload,
+            "p_lease_seconds": lease_seconds,
+        },
+    ).execute()
+    return bool(resp and resp.data)
+
+
+async def aclaim_inbound_event(lease_seconds: int, max_attempts: int):
+    """Lease the next stored event no one is answering, or return None."""
+    if DATABASE_URL:
+        from backend import dbpg
+
+        return await dbpg.claim_inbound_event(lease_seconds, max_attempts)
+    client = await get_async_client()
+    resp = await client.rpc(
+        "claim_inbound_event",
+        {"lease_seconds": lease_seconds, "max_attempts": max_attempts},
+    ).execute()
+    return resp.data[0] if resp and resp.data else None
+
+
+async def aupdate_inbound_event(channel: str, event_id: str, update: dict):
+    if DATABASE_URL:
+        from backend import dbpg
 
-            processor(user_id, persona_id, unmemorized)
-            ids = [msg["id"] for msg in unmemorized]
-            get_table(table_name).update({"memorized": True}).in_("id", ids).execute()
+        await dbpg.update_inbound_event(channel, event_id, update)
+    else:
+        table = await aget_table("inbound_events")
+        await table.update(update).eq("channel", channel).eq(
+            "event_id", event_id
+        ).execute()
 
 
-def upload_attachment(user_id: str, persona_id: str, attachment: dict):
-    path = f"{user_id}/{persona_id}/{uuid.uuid4()}.{attachment['name'].split('.')[-1]}"
-    supabase.storage.from_("attachments").upload(
-        path, attachment["bytes"], {"content-type": attachment["mime_type"]}
+@traced("db.get_attachments")
+async def aget_attachments(digest: str):
+    table = await aget_table("attachments")
+    resp = (
+        await table.select("user_id,file_path,description").eq("hash", digest).execute()
     )
+    return resp.data if resp and resp.data else []
+
+
+async def asave_attachment(digest: str, user_id: str, file_path: str, description):
+    table = await aget_table("attachments")
+    await table.upsert(
+        {
+            "hash": digest,
+            "user_id": user_id,
+            "file_path": file_path,
+            "description": description,
+        },
+        on_conflict="hash,user_id",
+        ignore_duplicates=True,
+    ).execute()
+
+
+@traced("db.upload_attachment")
+async def aupload_attachment(user_id: str, persona_id: str, attachment: dict):
+    path = _attachment_path(user_id, persona_id, attachment)
+    client = await get_async_client()
+    # streamed from the spooled file rather than read into memory
+    with open(attachment["path"], "rb") as f:
+        await client.storage.from_("attachments").upload(
+            path, f, {"content-type": attachment["mime_type"]}
+        )
     return path
 
 
-def update_server_address(address: str):
-    get_table("server").upsert({"id": 1, "url": address}).execute()
+async def aupdate_server_address(address: str):
+    await (await aget_table("server")).upsert({"id": 1, "url": address}).execute()
+    server_cache.set("url", address)
 
 
-def get_server_address():
-    resp = get_table("server").select("url").eq("id", 1).maybe_single().execute()
-    return resp.data["url"] if resp.data else None
\ No newline at end of file
+@traced("db.get_server_address")
+async def aget_server_address():
+    if (url := server_cache.get("url")) is not None:
+        return url
+    table = await aget_table("server")
+    resp = await table.select("url").eq("id", 1).maybe_single().execute()
+    url = resp.data["url"] if resp and resp.data else None
+    if url:
+        server_cache.set("url", url)
+    return url
@@ -0,0 +1,192 @@
+"""The responder's hot queries run directly against Postgres, used by backend.dbp when DATABASE_URL is set.
+
+Each query otherwise makes an HTTPS round trip through PostgREST. Here they run
+as prepared statements on a pool of open connections. Rows are serialized to
+json by Postgres just as PostgREST does, so ids and timestamps come back as the
+same strings either way.
+"""
+
+import os
+import asyncio
+
+from psycopg import sql
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+
+from backend.dbp import DATABASE_URL
+
+# connections per process, every instance holds its own pool
+POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 10))
+
+_pool = None
+_pool_lock = asyncio.Lock()
+# composed statements by shape, so each one is prepared once per connection
+_statements = {}
+
+
+async def get_pool():
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                pool = AsyncConnectionPool(
+                    DATABASE_URL,
+                    min_size=1,
+                    max_size=POOL_SIZE,
+                    kwargs={"autocommit": True},
+                    open=False,
+                )
+                await pool.open()
+                _pool = pool
+    return _pool
+
+
+async def fetchval(statement, params):
+    """Run a prepared statement and return the first column of its first row, if any."""
+    async with (await get_pool()).connection() as conn:
+        cursor = await conn.execute(statement, params, prepare=True)
+        row = await cursor.fetchone()
+    return row[0] if row else None
+
+
+async def execute(statement, params):
+    """Run a prepared statement for its effect."""
+    async with (await get_pool()).connection() as conn:
+        await conn.execute(statement, params, prepare=True)
+
+
+def _statement(key, build):
+    if key not in _statements:
+        _statements[key] = build()
+    return _statements[key]
+
+
+async def resolve_conversation(channel: str, address: str, persona_id: str):
+    return await fetchval(
+        "select public.resolve_conversation(%s, %s, %s)", (channel, address, persona_id)
+    )
+
+
+async def get_messages(
+    table: str, user_id: str, persona_id: str, channel: str, memorized, columns, limit
+):
+    """Return a conversation's latest messages, newest first like the PostgREST query."""
+
+    def build():
+        selected = (
+            sql.SQL("*")
+            if columns == "*"
+            else sql.SQL(", ").join(map(sql.Identifier, columns.split(",")))
+        )
+        return sql.SQL(
+            "select coalesce(json_agg(m), '[]') from ("
+            "select {} from {} where user_id = %s and persona_id = %s and channel = %s{}"
+            " order by created_at desc limit %s) m"
+        ).format(
+            selected,
+            sql.Identifier(table),
+            sql.SQL(" and memorized = %s" if memorized is not None else ""),
+        )
+
+    statement = _statement(("messages", table, columns, memorized is None), build)
+    params = [user_id, persona_id, channel]
+    if memorized is not None:
+        params.append(memorized)
+    return await fetchval(statement, [*params, limit])
+
+
+async def insert_message(table: str, message: dict):
+    def build():
+        return sql.SQL("insert into {} ({}) values ({})").format(
+            sql.Identifier(table),
+            sql.SQL(", ").join(map(sql.Identifier, message)),
+            sql.SQL(", ").join(sql.Placeholder() * len(message)),
+        )
+
+    statement = _statement(("insert", table, tuple(message)), build)
+    await execute(statement, list(message.values()))
+
+
+async def save_message_and_claim(params: dict):
+    def build():
+        return sql.SQL("select public.save_message_and_claim({})::text[]").format(
+            sql.SQL(", ").join(
+                sql.SQL("{} => {}").format(sql.Identifier(name), sql.Placeholder(name))
+                for name in params
+            )
+        )
+
+    statement = _statement(("save_and_claim", tuple(params)), build)
+    return await fetchval(statement, params)
+
+
+async def release_batch(table: str, ids: list):
+    """Mark a claimed batch unmemorized again, so the next reply claims it."""
+    statement = _statement(
+        ("release", table),
+        lambda: sql.SQL(
+            "update {} set memorized = false where id = any(%s::uuid[])"
+        ).format(sql.Identifier(table)),
+    )
+    await execute(statement, [ids])
+
+
+async def get_summary(user_id: str, persona_id: str, channel: str):
+    return await fetchval(
+        "select json_build_object('summary', summary, 'summarized_through', summarized_through)"
+        " from public.conversation_summaries"
+        " where user_id = %s and persona_id = %s and channel = %s",
+        (user_id, persona_id, channel),
+    )
+
+
+async def acquire_conversation_lease(key: str, holder: str, seconds: int):
+    return await fetchval(
+        "select public.acquire_conversation_lease(%s, %s, %s)", (key, holder, seconds)
+    )
+
+
+async def release_conversation_lease(key: str, holder: str):
+    await execute("select public.release_conversation_lease(%s, %s)", (key, holder))
+
+
+async def bump_conversation_generation(key: str):
+    return await fetchval("select public.bump_conversation_generation(%s)", (key,))
+
+
+async def get_conversation_generation(key: str):
+    return await fetchval(
+        "select coalesce((select generation from public.conversation_leases where key = %s), 0)",
+        (key,),
+    )
+
+
+async def enqueue_inbound_event(
+    channel: str, event_id: str, payload: dict, lease_seconds: int
+):
+    return await fetchval(
+        "select public.enqueue_inbound_event(%s, %s, %s, %s)",
+        (channel, event_id, Jsonb(payload), lease_seconds),
+    )
+
+
+async def claim_inbound_event(lease_seconds: int, max_attempts: int):
+    """Lease the next stored event as a row of json, like PostgREST returns it."""
+    return await fetchval(
+        "select row_to_json(e) from public.claim_inbound_event(%s, %s) e",
+        (lease_seconds, max_attempts),
+    )
+
+
+async def update_inbound_event(channel: str, event_id: str, update: dict):
+    def build():
+        return sql.SQL(
+            "update public.inbound_events set {} where channel = %s and event_id = %s"
+        ).format(
+            sql.SQL(", ").join(
+                sql.SQL("{} = %s").format(sql.Identifier(column)) for column in update
+            )
+        )
+
+    statement = _statement(("update_inbound", tuple(update)), build)
+    await execute(statement, [*update.values(), channel, event_id])
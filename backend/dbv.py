@@ -4,44 +4,251 @@
 # For inquiries, contact vince@aprilintelligence.com
 
 import os
-from pinecone import Pinecone
+import re
+import fcntl
+import json
+import logging
+import hashlib
+import threading
+import contextlib
 
-pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
-_index_cache = {}
+from backend.tracing import span
 
+logger = logging.getLogger(__name__)
 
-def get_index(index_name):
-    """Retrieve the Pinecone index resource, w/ caching."""
-    if index_name in _index_cache:
-        return _index_cache[index_name]
-    index = pc.Index(index_name)
-    _index_cache[index_name] = index
-    return index
+
+class VectorStore:
+    def upsert(self, index_name, namespace, records):
+        """Upsert records of the form {"id", "text", ...fields} into a namespace"""
+        raise NotImplementedError("Subclasses must implement upsert()")
+
+    def query(self, index_name, namespace, query, top_k, fields):
+        """Return the top_k hits for a text query as {"_id", "_score", "fields"} dicts"""
+        raise NotImplementedError("Subclasses must implement query()")
+
+
+class PineconeStore(VectorStore):
+    """Pinecone indexes in integrated-embedding mode, the text is embedded server side."""
+
+    def __init__(self):
+        from pinecone import Pinecone
+
+        self.pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+        self._index_cache = {}
+
+    def get_index(self, index_name):
+        """Retrieve the Pinecone index resource, w/ caching."""
+        if index_name in self._index_cache:
+            return self._index_cache[index_name]
+        index = self.pc.Index(index_name)
+        self._index_cache[index_name] = index
+        return index
+
+    def upsert(self, index_name, namespace, records):
+        self.get_index(index_name).upsert_records(namespace, records)
+
+    def query(self, index_name, namespace, query, top_k, fields):
+        return (
+            self.get_index(index_name)
+            .search_records(
+                namespace=namespace,
+                query={
+                    "inputs": {"text": query},
+                    "top_k": top_k,
+                },
+                # rerank={
+                #     "model": "bge-reranker-v2-m3",
+                #     "top_n": top_n,
+                #     "rank_fields": ["text"]
+                # },
+                fields=fields,
+            )["result"]
+            .get("hits", [])
+        )
+
+
+class HashingEmbedder:
+    """A deterministic bag-of-words embedder, no model download and no network."""
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def __call__(self, texts):
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in re.findall(r"\w+", text.lower()):
+                digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                vectors[row, bucket] += 1 if digest[4] & 1 else -1
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+class SentenceTransformerEmbedder:
+    """A local sentence-transformers model, e.g. all-MiniLM-L6-v2."""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def __call__(self, texts):
+        return self.model.encode(
+            texts, normalize_embeddings=True, convert_to_numpy=True
+        ).astype("float32")
+
+
+class LocalStore(VectorStore):
+    """A flat cosine index per namespace, persisted under path as memory-mapped numpy files."""
+
+    def __init__(self, path, embedder):
+        self.path = path
+        self.embedder = embedder
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version(directory):
+        """Identify a namespace's files on disk, every upsert from any process replaces them."""
+        try:
+            return tuple(
+                (stat.st_ino, stat.st_mtime_ns)
+                for stat in (
+                    os.stat(os.path.join(directory, name))
+                    for name in ("vectors.npy", "records.json")
+                )
+            )
+        except FileNotFoundError:
+            return None
+
+    def _load(self, index_name, namespace):
+        import numpy as np
+
+        key = (index_name, namespace)
+        directory = os.path.join(self.path, index_name, namespace)
+        # the worker upserts from another process, so reload whenever the files were replaced
+        version = self._version(directory)
+        cached = self._namespaces.get(key)
+        if cached is not None and cached[3] == version:
+            return cached[:3]
+        vectors = np.zeros((0, self.embedder.dim), dtype=np.float32)
+        records = []
+        if version is not None:
+            loaded = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+            with open(os.path.join(directory, "records.json")) as f:
+                loaded_records = json.load(f)
+            if len(loaded) == len(loaded_records):
+                vectors, records = loaded, loaded_records
+            elif cached is not None:
+                # caught between the writer's two swaps, keep what we had until it's done
+                return cached[:3]
+            else:
+                version = None
+        self._namespaces[key] = (directory, vectors, records, version)
+        return directory, vectors, records
+
+    @contextlib.contextmanager
+    def _file_lock(self, index_name, namespace):
+        """Hold a namespace's lock file, so upserts from other processes wait their turn."""
+        directory = os.path.join(self.path, index_name, namespace)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def upsert(self, index_name, namespace, records):
+        import numpy as np
+
+        # read, merge and swap under both locks, or a concurrent writer's records are lost
+        with self._lock, self._file_lock(index_name, namespace):
+            directory, vectors, existing = self._load(index_name, namespace)
+            rows = {r["id"]: i for i, r in enumerate(existing)}
+            vectors, existing = np.array(vectors), list(existing)
+            embeddings = self.embedder([r["text"] for r in records])
+            for record, embedding in zip(records, embeddings):
+                if record["id"] in rows:
+                    vectors[rows[record["id"]]] = embedding
+                    existing[rows[record["id"]]] = record
+                else:
+                    rows[record["id"]] = len(existing)
+                    vectors = np.vstack([vectors, embedding[None, :]])
+                    existing.append(record)
+
+            # write then swap, so readers never see a half written index
+            os.makedirs(directory, exist_ok=True)
+            vectors_path = os.path.join(directory, "vectors.npy")
+            records_path = os.path.join(directory, "records.json")
+            np.save(vectors_path + ".tmp.npy", vectors)
+            with open(records_path + ".tmp", "w") as f:
+                json.dump(existing, f)
+            os.replace(vectors_path + ".tmp.npy", vectors_path)
+            os.replace(records_path + ".tmp", records_path)
+            self._namespaces[(index_name, namespace)] = (
+                directory,
+                np.load(vectors_path, mmap_mode="r"),
+                existing,
+                self._version(directory),
+            )
+
+    def query(self, index_name, namespace, query, top_k, fields):
+        import numpy as np
+
+        with self._lock:
+            _, vectors, records = self._load(index_name, namespace)
+        if not records:
+            return []
+        scores = vectors @ self.embedder([query])[0]
+        top = np.argsort(-scores)[:top_k]
+        return [
+            {
+                "_id": records[i]["id"],
+                "_score": float(scores[i]),
+                "fields": {f: records[i][f] for f in fields if f in records[i]},
+            }
+            for i in top
+        ]
+
+
+_store = None
+
+
+def get_store():
+    """Return the vector store, local if VECTOR_STORE=local and Pinecone otherwise."""
+    global _store
+    if _store is None:
+        if os.environ.get("VECTOR_STORE") == "local":
+            model_name = os.environ.get("LOCAL_EMBEDDING_MODEL")
+            _store = LocalStore(
+                os.environ.get("VECTOR_STORE_PATH", ".vectors"),
+                (
+                    SentenceTransformerEmbedder(model_name)
+                    if model_name
+                    else HashingEmbedder()
+                ),
+            )
+        else:
+            _store = PineconeStore()
+    return _store
 
 
 def index_upsert(index_name, namespace, records):
-    """Upsert an item into a Pinecone index."""
-    index = get_index(index_name)
-    index.upsert_records(namespace, records)
+    """Upsert an item into a vector index."""
+    with span("vector.upsert", index=index_name, records=len(records)):
+        get_store().upsert(index_name, namespace, records)
 
 
 def index_query(
     index_name, namespace, query, top_k=10, top_n=5, fields=["text", "timestamp"]
 ):
-    """Query an item from a Pinecone index."""
-    index = get_index(index_name)
-    hits = index.search_records(
-        namespace=namespace,
-        query={
-            "inputs": {"text": query},
-            "top_k": top_k,
-        },
-        # rerank={
-        #     "model": "bge-reranker-v2-m3",
-        #     "top_n": top_n,
-        #     "rank_fields": ["text"]
-        # },
-        fields=fields,
-    )["result"].get("hits", [])
-    print(f"Hits: {hits}")
+    """Query an item from a vector index."""
+    with span("vector.query", index=index_name, top_k=top_k) as s:
+        hits = get_store().query(index_name, namespace, query, top_k, fields)
+        s.set(hits=len(hits))
+    logger.debug("Hits: %s", hits)
     return hits
@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.utils import now
+from backend.tracing import span, propagate, configure_logging
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 30
+LEASE_SECONDS = 300
+
+
+class JobQueue:
+    """A durable queue of memory consolidation jobs, keyed on the last message id of each batch."""
+
+    def enqueue(self, user_id, persona_id, channel, message_ids):
+        """Enqueue a batch of messages and return False if it was already queued"""
+        raise NotImplementedError("Subclasses must implement enqueue()")
+
+    def claim(self):
+        """Lease the next runnable job and return it, or None if the queue is empty"""
+        raise NotImplementedError("Subclasses must implement claim()")
+
+    def complete(self, job_id):
+        """Mark a job as done"""
+        raise NotImplementedError("Subclasses must implement complete()")
+
+    def fail(self, job, error):
+        """Reschedule a failed job with backoff, or give up after MAX_ATTEMPTS"""
+        raise NotImplementedError("Subclasses must implement fail()")
+
+    def depth(self):
+        """Return the number of jobs in each status"""
+        raise NotImplementedError("Subclasses must implement depth()")
+
+    @staticmethod
+    def backoff(attempts):
+        return RETRY_BACKOFF_SECONDS * 2 ** max(attempts - 1, 0)
+
+
+class SupabaseQueue(JobQueue):
+    def __init__(self):
+        from backend.dbp import get_client, get_table
+
+        self.supabase = get_client()
+        self.get_table = get_table
+
+    def enqueue(self, user_id, persona_id, channel, message_ids):
+        job = {
+            "id": message_ids[-1],
+            "user_id": user_id,
+            "persona_id": persona_id,
+            "channel": channel,
+            "message_ids": message_ids,
+        }
+        resp = (
+            self.get_table("memory_jobs")
+            .upsert(job, on_conflict="id", ignore_duplicates=True)
+            .execute()
+        )
+        return bool(resp and resp.data)
+
+    def claim(self):
+        resp = self.supabase.rpc(
+            "claim_memory_job",
+            {"lease_seconds": LEASE_SECONDS, "max_attempts": MAX_ATTEMPTS},
+        ).execute()
+        return resp.data[0] if resp and resp.data else None
+
+    def complete(self, job_id):
+        self.get_table("memory_jobs").update({"status": "done"}).eq(
+            "id", job_id
+        ).execute()
+
+    def fail(self, job, error):
+        update = {"status": "pending", "last_error": str(error)}
+        if job["attempts"] >= MAX_ATTEMPTS:
+            update["status"] = "failed"
+        else:
+            run_after = now().add(seconds=self.backoff(job["attempts"]))
+            update["run_after"] = run_after.isoformat()
+        self.get_table("memory_jobs").update(update).eq("id", job["id"]).execute()
+
+    def depth(self):
+        counts = {}
+        for status in ("pending", "running", "failed"):
+            resp = (
+                self.get_table("memory_jobs")
+                .select("id", count="exact", head=True)
+                .eq("status", status)
+                .execute()
+            )
+            counts[status] = resp.count or 0
+        return counts
+
+
+class SQLiteQueue(JobQueue):
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as conn:
+            conn.execute(
+                """
+                create table if not exists memory_jobs (
+                    id          text    primary key,
+                    user_id     text    not null,
+                    persona_id  text    not null,
+                    channel     text    not null,
+                    message_ids text    not null,
+                    status      text    not null default 'pending',
+                    attempts    integer not null default 0,
+                    last_error  text,
+                    run_after   real    not null,
+                    created_at  real    not null
+                )
+                """
+            )
+            conn.execute(
+                "create index if not exists idx_memory_jobs_status on memory_jobs (status, run_after)"
+            )
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def enqueue(self, user_id, persona_id, channel, message_ids):
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "insert or ignore into memory_jobs (id, user_id, persona_id, channel, message_ids, run_after, created_at) values (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    message_ids[-1],
+                    user_id,
+                    persona_id,
+                    channel,
+                    json.dumps(message_ids),
+                    time.time(),
+                    time.time(),
+                ),
+            )
+            return cursor.rowcount == 1
+
+    def claim(self):
+        conn = self.connect()
+        try:
+            conn.execute("begin immediate")
+            # a worker that died on the final attempt leaves its job running, give up on it
+            conn.execute(
+                "update memory_jobs set status = 'failed', last_error = 'lease expired on attempt ' || attempts where status = 'running' and run_after <= ? and attempts >= ?",
+                (time.time(), MAX_ATTEMPTS),
+            )
+            row = conn.execute(
+                "select * from memory_jobs where status in ('pending', 'running') and run_after <= ? and attempts < ? order by run_after limit 1",
+                (time.time(), MAX_ATTEMPTS),
+            ).fetchone()
+            if row is None:
+                conn.execute("commit")
+                return None
+            conn.execute(
+                "update memory_jobs set status = 'running', attempts = attempts + 1, run_after = ? where id = ?",
+                (time.time() + LEASE_SECONDS, row["id"]),
+            )
+            conn.execute("commit")
+        except Exception:
+            conn.execute("rollback")
+            raise
+        finally:
+            conn.close()
+        job = dict(row)
+        job["attempts"] += 1
+        job["message_ids"] = json.loads(job["message_ids"])
+        return job
+
+    def complete(self, job_id):
+        with self.connect() as conn:
+            conn.execute("update memory_jobs set status = 'done' where id = ?", (job_id,))
+
+    def fail(self, job, error):
+        with self.connect() as conn:
+            if job["attempts"] >= MAX_ATTEMPTS:
+                conn.execute(
+                    "update memory_jobs set status = 'failed', last_error = ? where id = ?",
+                    (str(error), job["id"]),
+                )
+            else:
+                conn.execute(
+                    "update memory_jobs set status = 'pending', last_error = ?, run_after = ? where id = ?",
+                    (str(error), time.time() + self.backoff(job["attempts"]), job["id"]),
+                )
+
+    def depth(self):
+        with self.connect() as conn:
+            rows = conn.execute(
+                "select status, count(*) from memory_jobs where status != 'done' group by status"
+            ).fetchall()
+        counts = {"pending": 0, "running": 0, "failed": 0}
+        counts.update({status: count for status, count in rows})
+        return counts
+
+
+_queue = None
+
+
+def get_queue():
+    """Return the job queue, backed by SQLite if JOB_QUEUE_PATH is set and Supabase otherwise."""
+    global _queue
+    if _queue is None:
+        path = os.environ.get("JOB_QUEUE_PATH")
+        _queue = SQLiteQueue(path) if path else SupabaseQueue()
+    return _queue
+
+
+def run_job(job):
+    """Consolidate the batch of messages held by a job into long-term memory and the rolling summary."""
+    from backend.dbp import get_messages_by_ids
+    from backend.memory import processor, update_summary
+
+    messages = get_messages_by_ids(job["message_ids"])
+    if not messages:
+        return
+    args = (job["user_id"], job["persona_id"])
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        facts = pool.submit(propagate(processor), *args, messages)
+        summary = pool.submit(
+            propagate(update_summary), *args, job["channel"], messages
+        )
+        facts.result(), summary.result()
+
+
+def run_worker(max_jobs=None, idle_sleep=None):
+    """Drain the queue, returning once it is empty unless idle_sleep is set."""
+    queue, processed = get_queue(), 0
+    while max_jobs is None or processed < max_jobs:
+        job = queue.claim()
+        if job is None:
+            if idle_sleep is None:
+                break
+            time.sleep(idle_sleep)
+            continue
+        try:
+            with span("memory.job", attempt=job["attempts"]):
+                run_job(job)
+            queue.complete(job["id"])
+        except Exception as e:
+            logger.warning(
+                "Job %s failed on attempt %s: %s", job["id"], job["attempts"], e
+            )
+            queue.fail(job, e)
+        processed += 1
+    return processed
+
+
+if __name__ == "__main__":
+    configure_logging()
+    run_worker(idle_sleep=float(sys.argv[1]) if len(sys.argv) > 1 else 5)
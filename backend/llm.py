@@ -6,58 +6,187 @@
 import os
 import json
 import base64
-import requests
-
-from openai import OpenAI
+import asyncio
+import logging
 
 from backend.tools import search_internet, get_facts
-from backend.utils import handle_tool_call
-
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY")
-)
-
-
-def llm_call(persona, profile_id, persona_id, msgs):
-    new_msgs = []
-    for m in msgs:
-        new_msgs.append({"role": m["role"], "content": m["content"]})
-        if m.get("file_description"):
-            new_msgs.append(
-                {
-                    "role": "system",
-                    "content": f"The user sent you an image with the following description: \n {m['file_description']}",
-                }
-            )
+from backend.utils import handle_tool_calls
+from backend.context import build_context
+from backend import metrics
+from backend.tracing import span, traced, current
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+
+# built on first use, openai takes ~500ms to import and most cold starts never call it
+_client = None
+_async_client = None
 
-    tools = [search_internet.spec, get_facts.spec]
-    new_msgs[:0] = [{"role": "system", "content": persona["prompt"]}]
+# tool: the model calls get_facts itself, prefetch: facts are retrieved up front, hybrid: both
+MEMORY_MODES = ("tool", "prefetch", "hybrid")
 
-    print(new_msgs)
 
-    for _ in range(5):
-        resp = client.chat.completions.create(
-            model=persona["model"],
-            messages=new_msgs,
-            tools=tools,
-            tool_choice="auto",
-            temperature=persona["temperature"],
-            max_tokens=100,
+def get_client():
+    global _client
+    if _client is None:
+        from openai import OpenAI
+
+        _client = OpenAI(
+            base_url=OPENROUTER_BASE_URL, api_key=os.getenv("OPENROUTER_API_KEY")
         )
-        print("Full JSON:", resp)
-        message = resp.choices[0].message
-        new_msgs.append(message)
-        if message.tool_calls:
-            for tool_call in message.tool_calls:
-                new_msgs.append(handle_tool_call(profile_id, persona_id, tool_call))
-        else:
-            return message.content
-    return message.content
+    return _client
 
 
-def get_attachment_description(data, mime_type):
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        from openai import AsyncOpenAI
+
+        _async_client = AsyncOpenAI(
+            base_url=OPENROUTER_BASE_URL, api_key=os.getenv("OPENROUTER_API_KEY")
+        )
+    return _async_client
+
+
+def get_tools(persona):
+    # when facts are prefetched the model has no need for the memory tool
+    if persona.get("memory_mode") == "prefetch":
+        return [search_internet.spec]
+    return [search_internet.spec, get_facts.spec]
+
+
+async def prefetch_facts(persona, profile_id, persona_id, query):
+    """Search both memory indexes for the latest user turn if the persona prefetches memory."""
+    if persona.get("memory_mode", "tool") == "tool" or not query:
+        return None
+    with span("prefetch_facts"):
+        return await asyncio.to_thread(get_facts, profile_id, persona_id, query, query)
+
+
+def record_usage(s, model, usage):
+    """Attach an OpenRouter response's token counts to a span and the token counters."""
+    if usage is None:
+        return
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    tokens = {
+        "prompt": usage.get("prompt_tokens") or 0,
+        "completion": usage.get("completion_tokens") or 0,
+        # the part of the prompt served from the provider's prefix cache
+        "cached": (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0,
+    }
+    s.set(
+        model=model,
+        prompt_tokens=tokens["prompt"],
+        completion_tokens=tokens["completion"],
+        cached_tokens=tokens["cached"],
+    )
+    for kind, count in tokens.items():
+        metrics.incr("llm_tokens", count, model=model, kind=kind)
+
+
+async def llm_stream(persona, profile_id, persona_id, msgs, facts=None, summary=None):
+    """Answer a conversation, yielding the reply's text deltas as they are generated."""
+    new_msgs = build_context(persona, msgs, facts, summary)
+    tools = get_tools(persona)
+    memory_mode = persona.get("memory_mode", "tool")
+    metrics.incr("llm_replies", memory_mode=memory_mode)
+    logger.debug("LLM request: %s", new_msgs)
+
+    for iteration in range(5):
+        metrics.incr("llm_calls", memory_mode=memory_mode)
+        with span("llm.stream", iteration=iteration) as s:
+            stream = await get_async_client().chat.completions.create(
+                model=persona["model"],
+                messages=new_msgs,
+                tools=tools,
+                tool_choice="auto",
+                temperature=persona["temperature"],
+                max_tokens=100,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            content, tool_calls = "", {}
+            # closes the connection too when a newer message cancels this reply
+            async with stream:
+                async for chunk in stream:
+                    # the token counts ride on the last chunk
+                    record_usage(s, persona["model"], chunk.usage)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        if not content:
+                            s.set(first_token_ms=s.elapsed_ms())
+                        content += delta.content
+                        yield delta.content
+                    # tool calls arrive in fragments, stitch them back together by index
+                    for fragment in delta.tool_calls or []:
+                        call = tool_calls.setdefault(
+                            fragment.index,
+                            {
+                                "id": "",
+                                "type": "function",
+                                "function": {"name": "", "arguments": ""},
+                            },
+                        )
+                        call["id"] = fragment.id or call["id"]
+                        if fragment.function:
+                            call["function"]["name"] += fragment.function.name or ""
+                            call["function"]["arguments"] += (
+                                fragment.function.arguments or ""
+                            )
+        logger.debug("LLM response: %s %s", content, tool_calls)
+        if not tool_calls:
+            return
+        from openai.types.chat import ChatCompletionMessageToolCall
+
+        calls = [
+            ChatCompletionMessageToolCall.model_validate(c) for c in tool_calls.values()
+        ]
+        new_msgs.append(
+            {"role": "assistant", "content": content or None, "tool_calls": calls}
+        )
+        new_msgs.extend(await handle_tool_calls(profile_id, persona_id, calls))
+
+
+def memory_mode_stats():
+    """LLM calls per reply for each memory mode, and how many it saves over tool-only."""
+    per_reply = {}
+    for mode in MEMORY_MODES:
+        if replies := metrics.get("llm_replies", memory_mode=mode):
+            per_reply[mode] = metrics.get("llm_calls", memory_mode=mode) / replies
+    baseline = per_reply.get("tool")
+    return {
+        mode: {
+            "llm_calls_per_reply": calls,
+            "llm_calls_saved_per_reply": baseline - calls if baseline else None,
+        }
+        for mode, calls in per_reply.items()
+    }
+
+
+def prompt_cache_stats():
+    """Prompt tokens per model and the share of them served from the provider's prefix cache."""
+    totals = {}
+    for labels, value in metrics.labelled("llm_tokens"):
+        if labels["kind"] in ("prompt", "cached"):
+            model = totals.setdefault(labels["model"], {"prompt": 0, "cached": 0})
+            model[labels["kind"]] += value
+    return {
+        model: {
+            "prompt_tokens": t["prompt"],
+            "cached_tokens": t["cached"],
+            "cache_hit_rate": t["cached"] / t["prompt"] if t["prompt"] else 0,
+        }
+        for model, t in totals.items()
+    }
+
+
+def _attachment_description_request(data, mime_type):
     data_url = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
-    resp = client.chat.completions.create(
+    return dict(
         model="google/gemini-2.0-flash-001",
         messages=[
             {
@@ -77,12 +206,30 @@ def get_attachment_description(data, mime_type):
         frequency_penalty=1,
         presence_penalty=1,
     )
+
+
+def get_attachment_description(data, mime_type):
+    request = _attachment_description_request(data, mime_type)
+    with span("llm.vision", bytes=len(data)) as s:
+        resp = get_client().chat.completions.create(**request)
+        record_usage(s, request["model"], resp.usage)
     return resp.choices[0].message.content
 
 
+async def aget_attachment_description(data, mime_type):
+    request = _attachment_description_request(data, mime_type)
+    with span("llm.vision", bytes=len(data)) as s:
+        resp = await get_async_client().chat.completions.create(**request)
+        record_usage(s, request["model"], resp.usage)
+    return resp.choices[0].message.content
+
+
+@traced("llm.structured")
 def structured_call(model_id, messages, schema):
+    import requests
+
     response = requests.post(
-        "https://openrouter.ai/api/v1/chat/completions",
+        f"{OPENROUTER_BASE_URL}/chat/completions",
         headers={
             "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
             "Content-Type": "application/json",
@@ -93,5 +240,7 @@ def structured_call(model_id, messages, schema):
             "response_format": {"type": "json_schema", "json_schema": schema},
         },
     )
-    print(response.json())
-    return json.loads(response.json()["choices"][0]["message"]["content"])
\ No newline at end of file
+    body = response.json()
+    logger.debug("Structured response: %s", body)
+    record_usage(current(), model_id, body.get("usage"))
+    return json.loads(body["choices"][0]["message"]["content"])
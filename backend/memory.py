@@ -3,97 +3,216 @@
 # Unauthorized use, distribution, or copying is prohibited.
 # For inquiries, contact vince@aprilintelligence.com
 
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
 from backend.dbv import index_upsert, index_query
 from backend.llm import structured_call
-from backend.utils import now
+from backend.utils import now, parse_time
+from backend.dbp import get_summary, save_summary
+from backend.tracing import traced, propagate
+
+logger = logging.getLogger(__name__)
 
 THRESHOLD = 0.5
 
 
+@traced("memory.consolidate")
 def processor(user_id, persona_id, conversation_history):
     curr_id = conversation_history[-1]["id"]
 
     # split conversation text into factual chunks about the user and the agent
     chunks_by_role = chunker(conversation_history)
-    print(f"Chunks by role: {chunks_by_role}")
-    # process user and agent chunks to figure out final text for each chunk
+    logger.debug("Chunks by role: %s", chunks_by_role)
+    # process user and agent chunks to figure out final text for each chunk, one index per thread
     namespace = f"{user_id}/{persona_id}"
-    process_chunks_for_index(
-        "memories-user", namespace, curr_id, chunks_by_role.get("user_facts", [])
-    )
-    process_chunks_for_index(
-        "memories-agent", namespace, curr_id, chunks_by_role.get("agent_facts", [])
-    )
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        user = pool.submit(
+            propagate(process_chunks_for_index),
+            "memories-user",
+            namespace,
+            curr_id,
+            chunks_by_role.get("user_facts", []),
+        )
+        agent = pool.submit(
+            propagate(process_chunks_for_index),
+            "memories-agent",
+            namespace,
+            curr_id,
+            chunks_by_role.get("agent_facts", []),
+        )
+        user.result(), agent.result()
 
 
 def process_chunks_for_index(index, namespace, curr_id, text_chunks):
-    """Processes chunks by looking for matches and merging if necessary."""
-    records, counter = [], 0
-    for chunk_text in text_chunks:
-        matches = index_query(index, namespace, chunk_text, top_k=1)
-        if matches:
-            best_match = matches[0]
-            print(f"Best match: {best_match}")
-            if (
-                best_match.get("_score", 0) > THRESHOLD
-            ):  # found a match; attempt_merge with existing text
-                merged_text = merger(
-                    best_match.get("fields", {}).get("text", ""), chunk_text
-                )
-                print(f"Merged text: {merged_text}")
-                if merged_text:  # we'll overwrite the existing vector
-                    records.append(
-                        {
-                            "id": best_match.get("_id", ""),
-                            "text": merged_text,
-                            "timestamp": now().isoformat(),
-                        }
-                    )
-                    continue
-        # if no high match or attempt_merge returned "", we create a new vector
+    """Processes chunks by looking up all their matches at once and resolving the overlaps in a single merge call."""
+    if not text_chunks:
+        return []
+
+    # look up the closest existing fact for every chunk concurrently
+    with ThreadPoolExecutor(max_workers=min(len(text_chunks), 8)) as pool:
+        all_matches = list(
+            pool.map(
+                propagate(lambda c: index_query(index, namespace, c, top_k=1)),
+                text_chunks,
+            )
+        )
+
+    # group chunks by the existing fact they matched, so no two chunks overwrite the same id
+    records, groups, counter = [], {}, 0
+
+    def new_record(text):
+        nonlocal counter
         records.append(
-            {
-                "id": f"{curr_id}_{counter}",
-                "text": chunk_text,
-                "timestamp": now().isoformat(),
-            }
+            {"id": f"{curr_id}_{counter}", "text": text, "timestamp": now().isoformat()}
         )
         counter += 1
+
+    for chunk_text, matches in zip(text_chunks, all_matches):
+        best_match = matches[0] if matches else {}
+        if best_match.get("_score", 0) > THRESHOLD:
+            group = groups.setdefault(
+                best_match.get("_id", ""),
+                {"existing": best_match.get("fields", {}).get("text", ""), "new": []},
+            )
+            group["new"].append(chunk_text)
+        else:
+            new_record(chunk_text)
+
+    # resolve every group in one call, every chunk not merged into its match becomes a new vector
+    resolutions = batch_merger(groups) if groups else {}
+    logger.debug("Resolutions: %s", resolutions)
+    for match_id, group in groups.items():
+        resolution = resolutions.get(match_id, {})
+        merged = set()
+        if resolution.get("resolved_fact"):  # we'll overwrite the existing vector
+            records.append(
+                {
+                    "id": match_id,
+                    "text": resolution["resolved_fact"],
+                    "timestamp": now().isoformat(),
+                }
+            )
+            merged = set(resolution.get("merged_facts", []))
+        # including any the model left out of its answer, so no chunk is ever dropped
+        for i, chunk_text in enumerate(group["new"]):
+            if str(i) not in merged:
+                new_record(chunk_text)
     if records:
         index_upsert(index, namespace, records)
     return records
 
 
-def merger(first_piece, second_piece):
-    """Calls the Gemini model to resolve the conflicts between the user and agent chunks."""
+@traced("memory.merge")
+def batch_merger(groups):
+    """Calls the Claude model to resolve each existing fact against the new facts that matched it."""
     model_id = "anthropic/claude-3.5-haiku"
+    text = "\n".join(
+        GROUP_TEMPLATE.format(
+            id=match_id,
+            existing_fact=group["existing"],
+            new_facts="\n".join(
+                f'        <new_fact id="{i}">{fact}</new_fact>'
+                for i, fact in enumerate(group["new"])
+            ),
+        )
+        for match_id, group in groups.items()
+    )
     messages = [
         {"role": "system", "content": MERGE_SYSTEM},
+        {"role": "user", "content": MERGE_PROMPT.format(groups=text)},
+    ]
+    schema = {
+        "name": "resolutions",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "resolutions": {
+                    "type": "array",
+                    "description": "One resolution per group.",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {
+                                "type": "string",
+                                "description": "The id of the group being resolved.",
+                            },
+                            "resolved_fact": {
+                                "type": "string",
+                                "description": "Enter the resolved fact here, or an empty string if none of the new facts should be merged.",
+                            },
+                            "merged_facts": {
+                                "type": "array",
+                                "description": "The ids of the new facts combined into resolved_fact.",
+                                "items": {"type": "string"},
+                            },
+                        },
+                        "required": ["id", "resolved_fact", "merged_facts"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["resolutions"],
+            "additionalProperties": False,
+        },
+    }
+    response = structured_call(model_id, messages, schema)
+    return {r["id"]: r for r in response.get("resolutions", []) if r["id"] in groups}
+
+
+@traced("memory.summarize")
+def update_summary(user_id, persona_id, channel, conversation_history):
+    """Folds the messages the conversation's rolling summary doesn't cover yet into it."""
+    previous = get_summary(user_id, persona_id, channel)
+    if previous:
+        # a retried job must not fold the same batch in twice
+        through = parse_time(previous["summarized_through"])
+        conversation_history = [
+            m for m in conversation_history if parse_time(m["created_at"]) > through
+        ]
+    if not conversation_history:
+        return None
+
+    text = "\n".join(f"{m['role']}: {m['content']}" for m in conversation_history)
+    model_id = "anthropic/claude-3.5-haiku"
+    messages = [
+        {"role": "system", "content": SUMMARY_SYSTEM},
         {
             "role": "user",
-            "content": MERGE_PROMPT.format(
-                first_piece=first_piece, second_piece=second_piece
+            "content": SUMMARY_PROMPT.format(
+                summary=previous["summary"] if previous else "", text=text
             ),
         },
     ]
     schema = {
-        "name": "resolution",
+        "name": "summary",
         "strict": True,
         "schema": {
             "type": "object",
             "properties": {
-                "resolved_fact": {
+                "summary": {
                     "type": "string",
-                    "description": "Enter the resolved fact here, or an empty string if the facts are already consistent.",
-                },
+                    "description": "The updated summary of the whole conversation.",
+                }
             },
-            "required": ["resolved_fact"],
+            "required": ["summary"],
             "additionalProperties": False,
         },
     }
-    return structured_call(model_id, messages, schema).get("resolved_fact", "")
+    summary = structured_call(model_id, messages, schema).get("summary")
+    if summary:
+        save_summary(
+            user_id,
+            persona_id,
+            channel,
+            summary,
+            conversation_history[-1]["created_at"],
+        )
+    return summary
 
 
+@traced("memory.chunk")
 def chunker(conversation_history):
     """Calls the Claude model to split the provided conversation text into two sets of chunks."""
     text = "\n".join(f"{m['role']}: {m['content']}" for m in conversation_history)
@@ -140,7 +259,6 @@ def chunker(conversation_history):
     return response.get("facts", {})
 
 
-
 CHUNKING_SYSTEM = """
 You are an expert text classification system specializing in semantic chunking of conversations in a romantic relationship context.
 Your role is to analyze a conversation between a partner chatbot (the agent) and a human user, and extract only factual and actionable information that is useful for future interactions.
@@ -226,82 +344,95 @@ Remember to output only valid JSON using the structure shown in the example. Do
 
 MERGE_SYSTEM = """
 You are an expert text classification system specializing in merging semantically similar pieces of information.
-Your role is to analyze two pieces of factual information, and decide whether to combine the two pieces of information or keep them separate.
+Your role is to analyze groups of factual information, each made up of one existing fact and one or more new facts that were found to be similar to it, and decide for each group which new facts to combine with the existing fact and which to keep separate.
 
 Here are the instructions for the output:
 <instructions>
-    1. Analyze the two pieces of information (provided in <first_piece> and <second_piece>) to determine if they are about the same topic/entity/person/etc.
-    2. If the two pieces of information are about the same topic/entity/person/etc, combine the two pieces of information into a single piece of information while ensuring that we don't lose any details.
-        a. If the two pieces contain conflicting details, prioritize the <second_piece>, while allowing for the <first_piece> to provide additional context.
-        b. Return the merged piece of information in JSON format in resolved_fact.
-        c. Ensure your response is between 100 and 500 characters for optimal embedding.
-    3. Otherwise, the two pieces of information are not sufficiently similar, and so you should return an empty JSON object in resolved_fact.
-    4. Output only valid JSON using the structure shown in the example. Do not include any additional text or commentary.
+    1. For each <group>, analyze the <existing_fact> and each <new_fact> to determine if they are about the same topic/entity/person/etc.
+    2. Combine the existing fact and every new fact that is about the same topic/entity/person/etc into a single piece of information while ensuring that we don't lose any details.
+        a. If the pieces contain conflicting details, prioritize the new facts, while allowing for the existing fact to provide additional context.
+        b. Return the merged piece of information in resolved_fact.
+        c. Ensure the resolved fact is between 100 and 500 characters for optimal embedding.
+    3. Return the id of every new fact you combined into resolved_fact in merged_facts. New facts that are not sufficiently similar to the existing fact are kept separate, leave them out.
+    4. If none of the new facts in a group are sufficiently similar to the existing fact, return an empty string in resolved_fact and an empty list in merged_facts.
+    5. Return exactly one resolution per group, using the id of the group.
+    6. Output only valid JSON using the structure shown in the example. Do not include any additional text or commentary.
 </instructions>
 
-Here is an example of how to merge similar information:
+Here is an example of how to resolve groups:
 <example>
     INPUT:
-    <first_piece>
-        User has a dog named Max who is extremely important to them.
-    </first_piece>
-
-    <second_piece>
-        User has a golden retriever named Max.
-    </second_piece>
+    <group id="a1">
+        <existing_fact>User has a dog named Max who is extremely important to them.</existing_fact>
+        <new_fact id="0">User has a golden retriever named Max.</new_fact>
+        <new_fact id="1">User takes Max to the dog park every Sunday.</new_fact>
+        <new_fact id="2">User is learning to play the piano.</new_fact>
+    </group>
+    <group id="b2">
+        <existing_fact>User does not like the SuperBowl because their dad used to get drunk every year during the game.</existing_fact>
+        <new_fact id="0">User enjoyed the SuperBowl because they spent it with their friends.</new_fact>
+    </group>
+    <group id="c3">
+        <existing_fact>Agent has a dog named Max who is extremely important to them.</existing_fact>
+        <new_fact id="0">Agent has a cat named Waffles.</new_fact>
+    </group>
 
     OUTPUT:
     {
-        "resolved_fact": "Has a golden retriever named Max who is extremely important to them."
+        "resolutions": [
+            {
+                "id": "a1",
+                "resolved_fact": "User has a golden retriever named Max who is extremely important to them, and takes him to the dog park every Sunday.",
+                "merged_facts": ["0", "1"]
+            },
+            {
+                "id": "b2",
+                "resolved_fact": "User enjoyed the SuperBowl because they spent it with their friends, but previously didn't like it because their dad used to get drunk during the game.",
+                "merged_facts": ["0"]
+            },
+            {
+                "id": "c3",
+                "resolved_fact": "",
+                "merged_facts": []
+            }
+        ]
     }
 </example>
+"""
 
-Here is an example of how to merge conflicting information:
-<example>
-    INPUT:
-    <first_piece>
-        User does not like the SuperBowl because their dad used to get drunk every year during the game.
-    </first_piece>
-
-    <second_piece>
-        User enjoyed the SuperBowl because they spent it with their friends.
-    </second_piece>
+GROUP_TEMPLATE = """
+    <group id="{id}">
+        <existing_fact>{existing_fact}</existing_fact>
+{new_facts}
+    </group>"""
 
-    OUTPUT: 
-    {
-        "resolved_fact": "User enjoyed the SuperBowl because they spent it with their friends, but previously didn't like it because their dad used to get drunk during the game."
-    }
-</example>
+MERGE_PROMPT = """
+Here are the groups of information to resolve:
+<groups>
+{groups}
+</groups>
 
-Here is an example of when you should not merge information:
-<example>
-    INPUT:
-    <first_piece> 
-        Agent has a dog named Max who is extremely important to them.
-    </first_piece>
+Now, please decide for each group which new facts to merge into the existing fact and which to keep separate as described in your system prompt.
+Remember to output only valid JSON using the structure shown in the example. Do not include any additional text or commentary.
+"""
 
-    <second_piece>
-        Agent has a cat named Waffles.
-    </second_piece>
 
-    OUTPUT:
-    {
-        "resolved_fact": ""
-    }
-</example>
+SUMMARY_SYSTEM = """
+You maintain the running summary of a conversation between a partner chatbot (the agent) and a human user.
+The summary is given to the agent in place of the older messages, so it must carry everything the agent needs to continue the conversation naturally.
+Keep it in the third person, in plain prose, and under 200 words. Favour what is still relevant (ongoing plans, open questions, the current mood and topics) over what has been resolved.
 """
 
-MERGE_PROMPT = """
-Here is the first piece of information:
-<first_piece>
-    {first_piece}
-</first_piece>
+SUMMARY_PROMPT = """
+Here is the summary of the conversation so far, which may be empty if the conversation just started:
+<summary>
+{summary}
+</summary>
 
-Here is the second piece of information:
-<second_piece>
-    {second_piece}
-</second_piece>
+Here are the messages that came after it:
+<messages>
+{text}
+</messages>
 
-Now, please decide whether to merge these two pieces of information or to keep them separate as described in your system prompt.
-Remember to output only valid JSON using the structure shown in the example. Do not include any additional text or commentary.
+Return the summary updated with these messages.
 """
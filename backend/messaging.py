@@ -6,77 +6,177 @@
 import os
 import json
 import uuid
-import requests
-from backend.dbp import get_server_address
+import asyncio
+from backend.dbp import aget_server_address, server_cache
+from backend.attachments import spool, AttachmentTooLarge
+from backend.outbox import Outbox, DeliveryError
 
 
 class Messaging:
+    # whether a burst of texts is answered once, see backend.conversations
+    coalesce = False
+    # whether requests are webhook events, acknowledged at once and answered in the background
+    webhook = False
+    # paces and retries sends in the background, without one each message is delivered inline
+    outbox = None
+
     def __init__(self):
         self.MAX_PHOTO_SIZE_BYTES = 5 * 1024 * 1024
         self.MAX_MESSAGE_LENGTH = 500
         self.MAX_ATTACHMENTS = 1
         self.headers = {"Content-Type": "application/json"}
+        self._client = None
+
+    @property
+    def client(self):
+        """One pooled keep-alive client per backend so sends reuse warm connections, built on first use"""
+        if self._client is None:
+            import httpx
+
+            self._client = httpx.AsyncClient(
+                timeout=30,
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self._client
 
-    def parse(self, request):
-        """Parse the request and return (error, user_id, chat_id, message, attachment_data)"""
+    async def parse(self, event):
+        """Parse the request, or a webhook's JSON, and return (error, user_id, chat_id, message, attachment_data)"""
         raise NotImplementedError("Subclasses must implement parse()")
 
-    def send_message(self, chat_id, message):
-        """Send a message to the specified chat"""
-        raise NotImplementedError("Subclasses must implement send_message()")
+    def event_id(self, event):
+        """Return the id the service gives a webhook event, the same for every redelivery"""
+        raise NotImplementedError("Webhook subclasses must implement event_id()")
+
+    async def send_message(self, chat_id, message):
+        """Send a message to the specified chat, return a future of whether it was delivered
+
+        With an outbox the message is only queued, and the future resolves once it
+        was sent or given up on.
+        """
+        if self.outbox is not None:
+            return self.outbox.put(chat_id, message)
+        delivered = asyncio.get_running_loop().create_future()
+        await self.deliver(chat_id, message)
+        delivered.set_result(True)
+        return delivered
+
+    async def deliver(self, chat_id, message):
+        """Send a message to the specified chat, raising DeliveryError if it was refused"""
+        raise NotImplementedError("Subclasses must implement deliver()")
+
+    @staticmethod
+    def check_delivery(response):
+        """Raise DeliveryError unless the service accepted a send"""
+        if response.is_success:
+            return
+        retry_after = response.headers.get("Retry-After")
+        try:
+            # telegram says how long to wait in the body
+            body = response.json()
+            retry_after = body.get("parameters", {}).get("retry_after", retry_after)
+        except (ValueError, AttributeError):
+            pass
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        raise DeliveryError(
+            f"{response.status_code} {response.text[:200]}",
+            retryable=response.status_code == 429 or response.status_code >= 500,
+            retry_after=retry_after,
+        )
 
-    def send_typing_indicator(self, chat_id):
+    async def send_typing_indicator(self, chat_id):
         """Send a typing indicator to the specified chat"""
         raise NotImplementedError
 
-    def download_attachment(self, attachments):
+    async def download_attachment(self, attachments):
         """Download and process attachments"""
         raise NotImplementedError("Subclasses must implement download_attachment()")
 
+    async def spool_response(self, response, name, mime_type):
+        """Stream a response body to a temporary file, giving up as soon as it's too large"""
+        try:
+            response.raise_for_status()
+            # refuse up front when the server tells us the size
+            if (
+                int(response.headers.get("Content-Length") or 0)
+                > self.MAX_PHOTO_SIZE_BYTES
+            ):
+                raise AttachmentTooLarge(
+                    f"{name} is over {self.MAX_PHOTO_SIZE_BYTES} bytes"
+                )
+            return await spool(
+                response.aiter_bytes(), name, mime_type, self.MAX_PHOTO_SIZE_BYTES
+            )
+        finally:
+            await response.aclose()
+
+    async def too_large(self, chat_id):
+        error = "Attachment too large. Please keep it under 5MB."
+        await self.send_message(chat_id, error)
+        return error
+
 
 class Web(Messaging):
     def __init__(self):
         super().__init__()
 
-    def parse(self, request):
-        data = request.form
+    async def parse(self, request):
+        data = await request.form
         user_id = data.get("user_id")
         chat_id = data.get("persona_id")
         message = data.get("message")
-        attachment_file = request.files.get("attachment")
-        attachment_data = (
-            {
-                "name": attachment_file.filename,
-                "bytes": attachment_file.read(),
-                "mime_type": attachment_file.mimetype,
-            }
-            if attachment_file
-            else None
-        )
-
-        # we don't check for errors in web as it's all handled by the frontend
+        attachment_file = (await request.files).get("attachment")
+
+        # we don't check for errors in web as it's all handled by the frontend, except the size cap
+        attachment_data = None
+        if attachment_file:
+
+            async def chunks():
+                while chunk := attachment_file.stream.read(64 * 1024):
+                    yield chunk
+
+            try:
+                attachment_data = await spool(
+                    chunks(),
+                    attachment_file.filename,
+                    attachment_file.mimetype,
+                    self.MAX_PHOTO_SIZE_BYTES,
+                )
+            except AttachmentTooLarge:
+                return await self.too_large(chat_id), user_id, chat_id, message, None
 
         # return parsed request
         return None, user_id, chat_id, message, attachment_data
 
-    def send_message(self, chat_id, message):
+    async def deliver(self, chat_id, message):
+        # the reply goes back in the response
         pass
 
-    def send_typing_indicator(self, chat_id):
+    async def send_typing_indicator(self, chat_id):
         pass
 
-    def download_attachment(self, attachment_data):
+    async def download_attachment(self, attachment_data):
         pass
 
 
 class BlueBubbles(Messaging):
+    coalesce = True
+    webhook = True
+
     def __init__(self):
         super().__init__()
         self.params = {"password": os.getenv("BBL_API_KEY")}
+        self.outbox = Outbox("imessage", self.deliver)
 
-    def parse(self, request):
+    async def parse(self, event):
         # parse request
-        data = request.json.get("data", {})
+        data = event.get("data", {})
         user_id = data.get("handle").get("address")
         chat_id = data.get("chats")[0].get("guid")
         message = data.get("text", "")
@@ -95,48 +195,70 @@ class BlueBubbles(Messaging):
                 "Too many attachments. Please only send one image/audio file at a time."
             )
         if error:
-            self.send_message(chat_id, error)
+            await self.send_message(chat_id, error)
+            return error, user_id, chat_id, message, None
 
         # return parsed request
-        return error, user_id, chat_id, message, self.download_attachment(attachments)
+        try:
+            attachment_data = await self.download_attachment(attachments)
+        except AttachmentTooLarge:
+            return await self.too_large(chat_id), user_id, chat_id, message, None
+        return error, user_id, chat_id, message, attachment_data
+
+    def event_id(self, event):
+        return event.get("data", {}).get("guid")
+
+    async def request(self, method, path, stream=False, **kwargs):
+        import httpx
+
+        url = f"{await aget_server_address()}{path}"
+        try:
+            request = self.client.build_request(
+                method, url, headers=self.headers, params=self.params, **kwargs
+            )
+            return await self.client.send(request, stream=stream)
+        except httpx.TransportError:
+            # the server may have moved, so re-read its url on the next call
+            server_cache.invalidate()
+            raise
 
-    def send_message(self, chat_guid, message):
-        url = f"{get_server_address()}/api/v1/message/text"
+    async def deliver(self, chat_guid, message):
         data = json.dumps(
             {"chatGuid": chat_guid, "tempGuid": str(uuid.uuid4()), "message": message}
         )
-        requests.post(
-            url, headers=self.headers, data=data, params=self.params, timeout=30
-        )
+        response = await self.request("POST", "/api/v1/message/text", content=data)
+        self.check_delivery(response)
 
-    def send_typing_indicator(self, chat_guid):
-        url = f"{get_server_address()}/api/v1/chat/{chat_guid}/typing"
-        requests.post(url, headers=self.headers, params=self.params, timeout=30)
+    async def send_typing_indicator(self, chat_guid):
+        await self.request("POST", f"/api/v1/chat/{chat_guid}/typing")
 
-    def download_attachment(self, attachments):
+    async def download_attachment(self, attachments):
         if not attachments:
             return None
         attachment_id, mime_type = attachments[0]["guid"], attachments[0]["mimeType"]
-        url = f"{get_server_address()}/api/v1/attachment/{attachment_id}/download"
-        response = requests.get(
-            url, headers=self.headers, params=self.params, timeout=30
+        response = await self.request(
+            "GET", f"/api/v1/attachment/{attachment_id}/download", stream=True
         )
-        return {
-            "name": attachment_id,
-            "bytes": response.content,
-            "mime_type": mime_type,
-        }
+        return await self.spool_response(response, attachment_id, mime_type)
 
 
 class Telegram(Messaging):
+    coalesce = True
+    webhook = True
+
     def __init__(self):
         super().__init__()
         self.api_key = os.getenv("TELEGRAM_API_KEY")
-        self.url = f"https://api.telegram.org"
+        self.url = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+        # telegram allows about one message a second per chat, with short bursts
+        self.outbox = Outbox("telegram", self.deliver, chat_rate=1, chat_burst=3)
 
-    def parse(self, request):
+    def event_id(self, event):
+        return event.get("update_id")
+
+    async def parse(self, event):
         # parse request
-        data = request.json.get("message")
+        data = event.get("message")
         user_id = data.get("from").get("username")
         chat_id = data.get("chat").get("id")
         message = (
@@ -157,20 +279,49 @@ class Telegram(Messaging):
                 "Too many attachments. Please only send one image/audio file at a time."
             )
         if error:
-            self.send_message(chat_id, error)
+            await self.send_message(chat_id, error)
+            return error, user_id, chat_id, message, None
 
         # return parsed request
-        return error, user_id, chat_id, message, self.download_attachment(attachments)
+        try:
+            attachment_data = await self.download_attachment(attachments)
+        except AttachmentTooLarge:
+            return await self.too_large(chat_id), user_id, chat_id, message, None
+        return error, user_id, chat_id, message, attachment_data
 
-    def send_message(self, chat_id, message):
+    async def deliver(self, chat_id, message):
         url = f"{self.url}/bot{self.api_key}/sendMessage"
         data = json.dumps({"chat_id": chat_id, "text": message})
-        requests.post(url, headers=self.headers, data=data, timeout=30)
+        response = await self.client.post(url, headers=self.headers, content=data)
+        self.check_delivery(response)
+
+    async def get_updates(self, offset=None, timeout=0, limit=100):
+        """Long poll for up to limit updates from offset on, each one as a webhook would deliver it"""
+        data = json.dumps(
+            {
+                "offset": offset,
+                "timeout": timeout,
+                "limit": limit,
+                "allowed_updates": ["message"],
+            }
+        )
+        response = await self.client.post(
+            f"{self.url}/bot{self.api_key}/getUpdates",
+            headers=self.headers,
+            content=data,
+            timeout=timeout + 10,
+        )
+        # the url holds the api key, so keep it out of the error
+        if not response.is_success:
+            raise RuntimeError(
+                f"getUpdates failed: {response.status_code} {response.text[:200]}"
+            )
+        return response.json().get("result", [])
 
-    def send_typing_indicator(self, chat_id):
+    async def send_typing_indicator(self, chat_id):
         pass
 
-    def download_attachment(self, photo_sizes_list):
+    async def download_attachment(self, photo_sizes_list):
         if not photo_sizes_list:
             return None
         photo = max(
@@ -181,17 +332,14 @@ class Telegram(Messaging):
                 else 0
             ),
         )
-        response_file_path = requests.get(
+        response_file_path = await self.client.get(
             f"{self.url}/bot{self.api_key}/getFile",
             params={"file_id": photo.get("file_id")},
             timeout=10,
         )
         file_path = response_file_path.json().get("result").get("file_path")
-        response_bytes = requests.get(
-            f"{self.url}/file/bot{self.api_key}/{file_path}", timeout=30
+        request = self.client.build_request(
+            "GET", f"{self.url}/file/bot{self.api_key}/{file_path}"
         )
-        return {
-            "name": photo.get("file_id"),
-            "bytes": response_bytes.content,
-            "mime_type": "image/jpeg",
-        }
+        response = await self.client.send(request, stream=True)
+        return await self.spool_response(response, photo.get("file_id"), "image/jpeg")
@@ -0,0 +1,108 @@
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+# latency buckets in seconds, from a cache hit up to a slow consolidation job
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_counters = defaultdict(float)
+_histograms = {}
+_lock = threading.Lock()
+
+
+def incr(name, value=1, **labels):
+    """Add value to the counter identified by name and labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += value
+
+
+def get(name, **labels):
+    with _lock:
+        return _counters.get((name, tuple(sorted(labels.items()))), 0)
+
+
+def labelled(name):
+    """Return (labels, value) for every counter named name."""
+    with _lock:
+        return [(dict(l), v) for (n, l), v in _counters.items() if n == name]
+
+
+def observe(name, value, **labels):
+    """Record value in the histogram identified by name and labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        # one count per bucket plus +Inf, then the running sum
+        histogram = _histograms.setdefault(key, [0] * (len(BUCKETS) + 1) + [0.0])
+        histogram[bisect_left(BUCKETS, value)] += 1
+        histogram[-1] += value
+
+
+def _format(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+def snapshot():
+    """Return every counter as {"name{label=value,...}": value}."""
+    with _lock:
+        items = list(_counters.items())
+    result = {}
+    for (name, labels), value in items:
+        result[_format(name, labels)] = value
+    return result
+
+
+def histograms():
+    """Return every histogram as {"name{label=value,...}": {"count", "sum", "mean"}}."""
+    with _lock:
+        items = [(key, list(histogram)) for key, histogram in _histograms.items()]
+    result = {}
+    for (name, labels), histogram in items:
+        count = sum(histogram[:-1])
+        result[_format(name, labels)] = {
+            "count": count,
+            "sum": histogram[-1],
+            "mean": histogram[-1] / count if count else 0,
+        }
+    return result
+
+
+def prometheus():
+    """Render every counter and histogram in the Prometheus text exposition format."""
+
+    def series(name, labels, extra=()):
+        pairs = [*labels, *extra]
+        if not pairs:
+            return name
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+        return (
+            name
+            + "{"
+            + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped))
+            + "}"
+        )
+
+    with _lock:
+        counters = sorted(_counters.items())
+        hists = sorted((key, list(histogram)) for key, histogram in _histograms.items())
+    lines, typed = [], set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append(f"# TYPE {name}_total counter")
+            typed.add(name)
+        lines.append(f"{series(name + '_total', labels)} {value}")
+    for (name, labels), histogram in hists:
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, count in zip((*BUCKETS, "+Inf"), histogram[:-1]):
+            cumulative += count
+            lines.append(
+                f"{series(name + '_bucket', labels, [('le', bound)])} {cumulative}"
+            )
+        lines.append(f"{series(name + '_sum', labels)} {histogram[-1]}")
+        lines.append(f"{series(name + '_count', labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,143 @@
+import os
+import asyncio
+import logging
+from collections import deque
+
+from backend import metrics
+from backend.utils import TokenBucket, TTLCache
+from backend.tracing import span
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 30
+# messages a second each channel may send, telegram allows ~30 per bot and the
+# bluebubbles server relays through a single mac, so keep it from queueing up behind itself
+SEND_RATES = {"imessage": 10, "telegram": 30}
+for item in filter(None, os.environ.get("OUTBOX_RATES", "").split(",")):
+    channel, _, rate = item.partition("=")
+    SEND_RATES[channel] = float(rate)
+
+_outboxes = []
+
+
+class DeliveryError(Exception):
+    """A send the service refused, retry_after is how long it asked us to wait if it said."""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable, self.retry_after = retryable, retry_after
+
+
+class Outbox:
+    """Delivers a channel's messages in the background.
+
+    Sends are paced by a token bucket for the channel, SEND_RATES a second with
+    a second's worth of burst, and if chat_rate is set another for each chat.
+    Messages to one chat go out one at a time in the order they were put, at
+    most concurrency sends are in flight at once, and a failed send is retried
+    with exponential backoff, or after the retry_after the service asked for.
+    put() returns a future that resolves to whether the message was delivered.
+    Queues live in memory. The responder awaits these futures before an
+    inbound event is marked answered, so a crash mid-delivery has the event
+    answered again. deliver(chat_id, message) does the actual send. It raises
+    DeliveryError when the service refuses a message, or any other exception
+    for a network failure.
+    """
+
+    def __init__(self, channel, deliver, chat_rate=None, chat_burst=1, concurrency=8):
+        self.channel, self.deliver = channel, deliver
+        rate = SEND_RATES[channel]
+        self.bucket = TokenBucket(rate, max(int(rate), 1))
+        self.chat_rate, self.chat_burst = chat_rate, chat_burst
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # a chat's bucket outlives its queue, or a slow trickle of replies would skip the pacing
+        self._chat_buckets = TTLCache(maxsize=16384, ttl=60)
+        self._queues = {}
+        self._workers = {}
+        _outboxes.append(self)
+
+    def put(self, chat_id, message):
+        """Queue a message for a chat and return a future of whether it was delivered."""
+        delivered = asyncio.get_running_loop().create_future()
+        if chat_id not in self._queues:
+            self._queues[chat_id] = deque()
+            self._workers[chat_id] = asyncio.ensure_future(self._drain(chat_id))
+        self._queues[chat_id].append((message, delivered))
+        metrics.incr("sends", channel=self.channel, outcome="queued")
+        return delivered
+
+    async def join(self, chat_id=None):
+        """Wait until a chat's queue, or every queue, has been delivered."""
+        while worker := (
+            self._workers.get(chat_id)
+            if chat_id is not None
+            else next(iter(self._workers.values()), None)
+        ):
+            await asyncio.shield(worker)
+
+    def depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                message, delivered = queue[0]
+                sent = await self._send(chat_id, message)
+                queue.popleft()
+                delivered.set_result(sent)
+        finally:
+            # anything left when the worker is cancelled was never sent
+            for _, delivered in queue:
+                if not delivered.done():
+                    delivered.set_result(False)
+            del self._queues[chat_id], self._workers[chat_id]
+
+    def _chat_bucket(self, chat_id):
+        if self.chat_rate is None:
+            return None
+        if (bucket := self._chat_buckets.get(chat_id)) is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _send(self, chat_id, message):
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if bucket := self._chat_bucket(chat_id):
+                await bucket.acquire()
+            await self.bucket.acquire()
+            try:
+                async with self.semaphore:
+                    with span("send", chars=len(message), attempt=attempt):
+                        await self.deliver(chat_id, message)
+                metrics.incr("sends", channel=self.channel, outcome="sent")
+                return True
+            except DeliveryError as e:
+                error, retryable, retry_after = e, e.retryable, e.retry_after
+            except Exception as e:
+                error, retryable, retry_after = e, True, None
+            if not retryable or attempt == MAX_ATTEMPTS:
+                break
+            metrics.incr("sends", channel=self.channel, outcome="retried")
+            backoff = min(
+                RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_BACKOFF_SECONDS
+            )
+            await asyncio.sleep(max(backoff, retry_after or 0))
+        # give up on this message, the rest of the chat's queue still goes out
+        metrics.incr("sends", channel=self.channel, outcome="dropped")
+        logger.warning(
+            "Dropped %s message to %s after %d attempts: %s",
+            self.channel,
+            chat_id,
+            attempt,
+            error,
+        )
+        return False
+
+
+async def join(chat_id=None):
+    """Wait until every outbox has delivered what it holds, or only what it holds for chat_id."""
+    for outbox in _outboxes:
+        await outbox.join(chat_id)
@@ -0,0 +1,128 @@
+"""Answer Telegram by long polling getUpdates instead of through the webhook.
+
+    python -m backend.polling
+
+For a backend Telegram can't reach, or a bot busy enough to want its own
+process. Updates are fetched in batches of up to TELEGRAM_POLL_BATCH and
+answered TELEGRAM_POLL_WORKERS at a time through the same pipeline as the
+webhook, stored in inbound_events first so a failed answer is retried by the
+inbound worker. Telegram refuses getUpdates while a webhook is set, so delete
+it first (deleteWebhook).
+"""
+
+import os
+import signal
+import asyncio
+import logging
+import contextlib
+
+from backend import metrics, outbox
+from backend.conversations import inbox
+from backend.responder import respond
+from backend.messaging import Telegram
+from backend.tracing import span, configure_logging
+
+logger = logging.getLogger(__name__)
+
+# seconds telegram holds a poll open waiting for an update
+POLL_TIMEOUT = int(os.environ.get("TELEGRAM_POLL_TIMEOUT", 30))
+# updates fetched at once, telegram returns at most 100
+POLL_BATCH = int(os.environ.get("TELEGRAM_POLL_BATCH", 100))
+# replies in flight at once, a coalescing message holds its worker for the window
+POLL_WORKERS = int(os.environ.get("TELEGRAM_POLL_WORKERS", 32))
+MAX_BACKOFF_SECONDS = 30
+
+
+class Poller:
+    """Fetches a bot's updates and answers a bounded number of them at once.
+
+    The offset only moves past updates stored in the inbox, the same as a
+    webhook's acknowledgement, so one that is lost before it is answered is
+    still answered later. An update is only taken when a worker is free, so
+    when they fall behind the rest wait at Telegram rather than in memory.
+    Conversations are still answered one reply at a time, see
+    backend.conversations.ordered.
+    """
+
+    def __init__(
+        self, bot, workers=POLL_WORKERS, timeout=POLL_TIMEOUT, batch=POLL_BATCH
+    ):
+        self.bot, self.timeout, self.batch = bot, timeout, batch
+        self.slots = asyncio.Semaphore(workers)
+        self.offset = None
+
+    async def run(self):
+        """Poll until cancelled, then finish and deliver every update already taken."""
+        try:
+            await self.poll()
+        finally:
+            await inbox.join()
+            await outbox.join()
+            # telegram only forgets updates once a poll starts past them
+            if self.offset is not None:
+                with contextlib.suppress(Exception):
+                    await self.bot.get_updates(self.offset, limit=1)
+
+    async def poll(self):
+        delay = 1
+        while True:
+            try:
+                updates = await self.bot.get_updates(
+                    self.offset, self.timeout, self.batch
+                )
+            except Exception as e:
+                metrics.incr("polls", outcome="failed")
+                logger.warning("Polling telegram failed, retrying in %ss: %s", delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF_SECONDS)
+                continue
+            metrics.incr("polls", outcome="ok")
+            try:
+                for update in updates:
+                    await self.submit(update)
+                    self.offset = update["update_id"] + 1
+            except Exception as e:
+                # the rest of the batch is fetched again from the offset
+                logger.warning(
+                    "Storing telegram update failed, retrying in %ss: %s", delay, e
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF_SECONDS)
+                continue
+            delay = 1
+
+    async def submit(self, update):
+        """Store an update once a worker is free and start answering it, a duplicate is skipped."""
+        await self.slots.acquire()
+
+        async def answer():
+            try:
+                with span("responder"):
+                    await respond(self.bot, "telegram", update)
+            finally:
+                self.slots.release()
+
+        try:
+            stored = await inbox.submit(
+                "telegram", self.bot.event_id(update), update, answer
+            )
+        except BaseException:
+            self.slots.release()
+            raise
+        if not stored:
+            self.slots.release()
+
+
+async def main():
+    # stop on ctrl-c or a deploy's SIGTERM alike, after draining
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    with contextlib.suppress(asyncio.CancelledError):
+        await Poller(Telegram()).run()
+
+
+if __name__ == "__main__":
+    configure_logging()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(main())
@@ -0,0 +1,158 @@
+import json
+import asyncio
+import logging
+
+from backend.dbp import (
+    asave_message,
+    aget_messages,
+    aget_summary,
+    aresolve_conversation,
+)
+from backend.context import HISTORY_COLUMNS, MAX_HISTORY
+from backend.attachments import discard
+from backend.conversations import bursts, ordered
+from backend.llm import llm_stream, prefetch_facts
+from backend.utils import sanitized_sentences
+from backend.tracing import span, traced, current
+
+logger = logging.getLogger(__name__)
+
+
+async def respond(bot, channel, event, stream=False):
+    """Answer one inbound message end to end.
+
+    event is whatever bot.parse() reads, the request for the web channel and the
+    webhook's JSON otherwise. Returns a {"status", "message"} dict, or with stream
+    an async iterator of server sent events.
+    """
+    root = current()
+    root.set(channel=channel)
+
+    # parse and sanitize request
+    with span("parse"):
+        error, user_id, chat_id, message, attachment_data = await bot.parse(event)
+    logger.debug(
+        "Parsed %s message from %s: %s (attachment: %s)",
+        channel,
+        user_id,
+        message,
+        bool(attachment_data),
+    )
+    if error:
+        return {"status": 400, "message": error}
+
+    # the attachment is spooled to disk until the message that carries it is saved
+    try:
+        # send typing indicator while we get the user profile and persona
+        _, (profile, persona) = await asyncio.gather(
+            traced("send_typing")(bot.send_typing_indicator)(chat_id),
+            aresolve_conversation(channel, user_id, chat_id),
+        )
+
+        # save user message
+        await asave_message(
+            profile["id"], persona["id"], channel, "user", message, attachment_data
+        )
+    finally:
+        discard(attachment_data)
+
+    # texts sent in quick succession get one reply, from whichever of them came last
+    key = (channel, profile["id"], persona["id"])
+    if bot.coalesce:
+        with span("coalesce"):
+            generation = await bursts.settle(key)
+        if generation is None:
+            root.set(coalesced=True)
+            return {"status": 200, "message": "coalesced"}
+
+    async def reply_sentences():
+        # load the history and its summary while we look up relevant memories
+        history, summary, facts = await asyncio.gather(
+            aget_messages(
+                profile["id"],
+                persona["id"],
+                channel,
+                columns=HISTORY_COLUMNS,
+                limit=MAX_HISTORY,
+            ),
+            aget_summary(profile["id"], persona["id"], channel),
+            prefetch_facts(persona, profile["id"], persona["id"], message),
+        )
+
+        # stream the llm response, sanitizing it a sentence at a time
+        return sanitized_sentences(
+            llm_stream(persona, profile["id"], persona["id"], history, facts, summary)
+        )
+
+    # for the web channel, stream the sentences back as server sent events
+    if stream:
+
+        async def events():
+            # the body outlives the handler, so hang its span off the request's explicitly
+            with span("stream", parent=root):
+                async with ordered(key):
+                    parts, finished = [], False
+                    try:
+                        async for sentence in await reply_sentences():
+                            parts.append(sentence)
+                            yield f"data: {json.dumps({'content': sentence})}\n\n"
+                        finished = True
+                        yield "data: [DONE]\n\n"
+                    except Exception:
+                        logger.exception("Streaming a %s reply failed", channel)
+                        error = "Failed to generate a reply."
+                        yield f"data: {json.dumps({'error': error})}\n\n"
+                    finally:
+                        # keep what the user already saw, even if they left or the reply broke off
+                        if finished or parts:
+                            await asyncio.shield(
+                                asave_message(
+                                    profile["id"],
+                                    persona["id"],
+                                    channel,
+                                    "assistant",
+                                    " ".join(parts),
+                                )
+                            )
+
+        return events()
+
+    # otherwise send each sentence as its own text as soon as it's complete,
+    # one reply at a time per conversation so each follows on from the last
+    async with ordered(key):
+        sentences = await reply_sentences()
+        sends = []
+
+        async def send_reply():
+            async for sentence in sentences:
+                # queued rather than sent, the outbox paces and retries delivery
+                sends.append((sentence, await bot.send_message(chat_id, sentence)))
+
+        finished = True
+        if bot.coalesce:
+            finished = await bursts.reply(key, generation, send_reply())
+            root.set(cancelled=not finished)
+        else:
+            await send_reply()
+
+    # the outbox keeps the chat's sends in order, so the conversation is let go once they're
+    # queued, and history only keeps what reached the user, later turns build on it
+    delivered = await asyncio.gather(*(future for _, future in sends))
+    parts = [sentence for (sentence, _), sent in zip(sends, delivered) if sent]
+    if len(parts) < len(sends):
+        root.set(dropped=len(sends) - len(parts))
+        logger.warning(
+            "%d of %d sentences to %s were not delivered",
+            len(sends) - len(parts),
+            len(sends),
+            chat_id,
+        )
+    response = " ".join(parts)
+    # a cancelled reply keeps what was already sent, the newer one follows on from it
+    if finished or parts:
+        await asave_message(
+            profile["id"], persona["id"], channel, "assistant", response
+        )
+
+    # for the web channel
+    return {"status": 200, "message": {"role": "assistant", "content": response}}
@@ -1,12 +1,45 @@
 import os
-from exa_py import Exa
+import re
+import unicodedata
 from typing import Annotated
+from concurrent.futures import ThreadPoolExecutor
 
 from backend.dbv import index_query
-from backend.utils import tool
+from backend.utils import tool, now, parse_time, TTLCache, SingleFlight
+from backend.tracing import propagate
+from backend import metrics
 
+# separate from the tool executor so a tool never waits on a slot held by its caller
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="facts")
 
-@tool
+# how long an answer stays fresh, by how fast the answer to that kind of question changes
+SEARCH_TTLS = {"live": 10 * 60, "recent": 6 * 60 * 60, "evergreen": 7 * 24 * 60 * 60}
+for item in filter(None, os.environ.get("SEARCH_CACHE_TTLS", "").split(",")):
+    query_class, _, ttl = item.partition("=")
+    SEARCH_TTLS[query_class] = int(ttl)
+
+# checked in order, anything that matches neither is evergreen
+QUERY_CLASSES = [
+    (
+        "live",
+        re.compile(
+            r"\b(weather|forecast|temperature|score|scores|game|match|tonight|today|now|live|stocks?|price|traffic|breaking)\b"
+        ),
+    ),
+    (
+        "recent",
+        re.compile(
+            r"\b(news|latest|recent|recently|current|currently|yesterday|last night|this (week|month|year)|upcoming|new|release|election)\b"
+        ),
+    ),
+]
+
+_exa = None
+_search_cache = TTLCache(maxsize=4096, ttl=SEARCH_TTLS["evergreen"])
+_search_flight = SingleFlight()
+
+
+@tool(timeout=10)
 def get_facts(
     user_id: str,
     persona_id: str,
@@ -32,22 +65,67 @@ def get_facts(
             else []
         )
 
+    def search(index_name, query):
+        return format_hits(index_query(index_name, namespace, query)) if query else []
+
+    # query both indexes at the same time
     namespace = f"{user_id}/{persona_id}"
-    user_facts = (
-        format_hits(index_query("memories-user", namespace, user_query))
-        if user_query
-        else []
-    )
-    agent_facts = (
-        format_hits(index_query("memories-agent", namespace, agent_query))
-        if agent_query
-        else []
-    )
-    return {"facts_about_user": user_facts, "facts_about_you": agent_facts}
-
-
-@tool
+    user_facts = _executor.submit(propagate(search), "memories-user", user_query)
+    agent_facts = search("memories-agent", agent_query)
+    return {"facts_about_user": user_facts.result(), "facts_about_you": agent_facts}
+
+
+def get_exa():
+    global _exa
+    if _exa is None:
+        # deferred like the client, most requests never search
+        from exa_py import Exa
+
+        _exa = Exa(api_key=os.getenv("EXA_API_KEY"))
+    return _exa
+
+
+def normalize_query(query):
+    """Fold case, punctuation and spacing, so trivially different phrasings share a cache entry."""
+    query = unicodedata.normalize("NFKC", query).lower()
+    return " ".join(re.sub(r"[^\w\s]", " ", query).split())
+
+
+def classify_query(key):
+    return next((c for c, pattern in QUERY_CLASSES if pattern.search(key)), "evergreen")
+
+
+def _search(key, query):
+    query_class = classify_query(key)
+    # with a shared backend, an answer fetched by any instance is reused by all of them
+    shared = os.environ.get("SEARCH_CACHE_BACKEND") == "supabase"
+    if shared:
+        from backend.dbp import get_search_answer
+
+        if cached := get_search_answer(key):
+            metrics.incr("search_cache", result="shared_hit", query_class=query_class)
+            ttl = (parse_time(cached["expires_at"]) - now()).total_seconds()
+            _search_cache.set(key, cached["answer"], max(ttl, 1))
+            return cached["answer"]
+
+    metrics.incr("search_cache", result="miss", query_class=query_class)
+    answer = get_exa().answer(query, model="exa").answer
+    ttl = SEARCH_TTLS[query_class]
+    _search_cache.set(key, answer, ttl)
+    if shared:
+        from backend.dbp import save_search_answer
+
+        expires_at = now().add(seconds=ttl).isoformat()
+        save_search_answer(key, answer, query_class, expires_at)
+    return answer
+
+
+@tool(timeout=15)
 def search_internet(query: Annotated[str, "Question to ask the internet."]):
     """Get an answer to a question from the internet."""
-    exa = Exa(api_key=os.getenv("EXA_API_KEY"))
-    return exa.answer(query, model="exa").answer
+    key = normalize_query(query)
+    if (answer := _search_cache.get(key)) is not None:
+        metrics.incr("search_cache", result="hit", query_class=classify_query(key))
+        return answer
+    # concurrent askers of the same question wait for one request instead of sending their own
+    return _search_flight.do(key, _search, key, query)
@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import random
+import logging
+import functools
+import threading
+import contextvars
+from inspect import iscoroutinefunction
+
+from backend import metrics
+
+# every span feeds the latency histograms, only sampled traces are exported
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 1))
+
+_current = contextvars.ContextVar("span", default=None)
+_exporters = None
+
+
+class Span:
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.sampled = parent.sampled if parent else random.random() < SAMPLE_RATE
+        self.attributes = attributes
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.duration = None
+        self._start = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self._start) * 1000, 1)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class span:
+    """Time a stage of the request as a child of the current span, usable in sync and async code.
+
+    with span("db.get_messages", channel=channel) as s:
+        ...
+        s.set(rows=len(rows))
+    """
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name, self.parent, self.attributes = name, parent, attributes
+
+    def __enter__(self):
+        self.previous = _current.get()
+        self.span = Span(self.name, self.parent or self.previous, **self.attributes)
+        _current.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        # set rather than reset, a span held across a yield may close in another context
+        _current.set(self.previous)
+        s = self.span
+        s.duration = time.perf_counter() - s._start
+        if exc is not None:
+            s.error = repr(exc)
+            metrics.incr("span_errors", span=s.name)
+        metrics.observe("span_seconds", s.duration, span=s.name)
+        if s.sampled:
+            for exporter in get_exporters():
+                exporter.export(s)
+        return False
+
+
+def current():
+    """Return the active span, or None outside of a trace."""
+    return _current.get()
+
+
+def traced(name=None):
+    """Wrap every call of a sync or async function in a span."""
+
+    def decorator(func):
+        span_name = name or func.__name__
+        if iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(func):
+    """Bind func to the current context, so spans it opens in a pool thread keep their parent."""
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # a context can only be entered by one thread at a time, so each call gets a copy
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+class Exporter:
+    def export(self, span):
+        """Ship a finished span somewhere"""
+        raise NotImplementedError("Subclasses must implement export()")
+
+
+class FileExporter(Exporter):
+    """Appends each span as a JSON line, for tests and local debugging."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+
+class OTLPExporter(Exporter):
+    """Batches spans in a background thread and posts them to an OTLP/HTTP collector as JSON."""
+
+    def __init__(self, endpoint, service_name="april", batch_size=256, interval=5):
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self.service_name = service_name
+        self.batch_size, self.interval = batch_size, interval
+        self._spans = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, daemon=True, name="otlp").start()
+
+    def export(self, span):
+        with self._lock:
+            self._spans.append(span)
+            if len(self._spans) >= self.batch_size:
+                self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                batch, self._spans = self._spans, []
+            if batch:
+                try:
+                    self._post(batch)
+                except Exception as e:
+                    # never let telemetry take the app down, drop the batch instead
+                    logging.getLogger(__name__).warning(
+                        "Dropped %d spans: %s", len(batch), e
+                    )
+
+    @staticmethod
+    def _attributes(attributes):
+        def value(v):
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        return [{"key": k, "value": value(v)} for k, v in attributes.items()]
+
+    def _post(self, batch):
+        import requests
+
+        spans = [
+            {
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "parentSpanId": s.parent_id or "",
+                "name": s.name,
+                "kind": 1,
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.start_ns + int(s.duration * 1e9)),
+                "attributes": self._attributes(s.attributes),
+                "status": {"code": 2, "message": s.error} if s.error else {},
+            }
+            for s in batch
+        ]
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": self._attributes(
+                            {"service.name": self.service_name}
+                        )
+                    },
+                    "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+                }
+            ]
+        }
+        requests.post(self.url, json=payload, timeout=10).raise_for_status()
+
+
+def get_exporters():
+    """Return the exporters configured by TRACE_FILE and OTEL_EXPORTER_OTLP_ENDPOINT."""
+    global _exporters
+    if _exporters is None:
+        _exporters = []
+        if path := os.environ.get("TRACE_FILE"):
+            _exporters.append(FileExporter(path))
+        if endpoint := os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+            _exporters.append(
+                OTLPExporter(endpoint, os.environ.get("OTEL_SERVICE_NAME", "april"))
+            )
+    return _exporters
+
+
+class SampledFilter(logging.Filter):
+    """Lets through only a fraction of the records below WARNING, errors always pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def configure_logging():
+    """Set up the root logger from LOG_LEVEL and LOG_SAMPLE_RATE."""
+    handler = logging.StreamHandler()
+    handler.addFilter(SampledFilter(float(os.environ.get("LOG_SAMPLE_RATE", 1))))
+    logging.basicConfig(
+        level=os.environ.get("LOG_LEVEL", "WARNING").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        handlers=[handler],
+    )
@@ -1,15 +1,31 @@
 import re
 import json
-import pendulum
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
 from inspect import signature, Parameter
 from typing import get_type_hints, get_args
 from decimal import Decimal, ROUND_HALF_UP
 
+from backend.tracing import span, propagate
+
+logger = logging.getLogger(__name__)
+
 TOOL_MAPPING = {}
+DEFAULT_TOOL_TIMEOUT = 20
+DEFAULT_TOOL_CONCURRENCY = 8
 
 
-def tool(func):
+def tool(
+    func=None, *, timeout=DEFAULT_TOOL_TIMEOUT, concurrency=DEFAULT_TOOL_CONCURRENCY
+):
     """A decorator that automatically generates a JSON schema for a function's input from its signature."""
+    if func is None:
+        return lambda f: tool(f, timeout=timeout, concurrency=concurrency)
     type_map = {
         str: "string",
         int: "integer",
@@ -29,6 +45,11 @@ def tool(func):
         if param.default is Parameter.empty:
             required.append(name)
     func.expected_params = list(sig.parameters.keys())
+    func.timeout = timeout
+    # a pool per tool, so calls stuck in one tool never hold up the others
+    func.executor = ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix=f"tool.{func.__name__}"
+    )
     func.spec = {
         "type": "function",
         "function": {
@@ -46,20 +67,22 @@ def tool(func):
 
 
 def handle_tool_call(user_id, persona_id, tool_call):
-    try:
-        tool_name = tool_call.function.name
-        tool_args = json.loads(tool_call.function.arguments)
-        tool_func = TOOL_MAPPING[tool_name]
-        extra_args = {}
-        if "user_id" in tool_func.expected_params:
-            extra_args["user_id"] = user_id
-        if "persona_id" in tool_func.expected_params:
-            extra_args["persona_id"] = persona_id
-        tool_result = tool_func(**extra_args, **tool_args)
-        content = json.dumps(tool_result)
-    except Exception as e:
-        content = "Error: " + str(e)
-    print(f"Tool call for {tool_name} returned {content}")
+    tool_name = tool_call.function.name
+    with span(f"tool.{tool_name}") as s:
+        try:
+            tool_args = json.loads(tool_call.function.arguments)
+            tool_func = TOOL_MAPPING[tool_name]
+            extra_args = {}
+            if "user_id" in tool_func.expected_params:
+                extra_args["user_id"] = user_id
+            if "persona_id" in tool_func.expected_params:
+                extra_args["persona_id"] = persona_id
+            tool_result = tool_func(**extra_args, **tool_args)
+            content = json.dumps(tool_result)
+        except Exception as e:
+            content = "Error: " + str(e)
+            s.set(error=str(e))
+    logger.debug("Tool call for %s returned %s", tool_name, content)
     return {
         "role": "tool",
         "tool_call_id": tool_call.id,
@@ -68,6 +91,174 @@ def handle_tool_call(user_id, persona_id, tool_call):
     }
 
 
+class TTLCache:
+    """A bounded, thread-safe LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.hits, self.misses = 0, 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        """Drop every entry, or only those where predicate(key, value) is true."""
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                return
+            for key in [k for k, (v, _) in self._data.items() if predicate(k, v)]:
+                del self._data[key]
+
+    def stats(self):
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one, the rest wait for its result."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class KeyedLock:
+    """An asyncio lock per key, dropped once nothing holds or waits for it."""
+
+    def __init__(self):
+        self._locks = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock, waiters = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = (lock, waiters + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, waiters = self._locks[key]
+            if waiters == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, waiters - 1)
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class TokenBucket:
+    """Lets through rate acquisitions a second on average and up to burst at once."""
+
+    def __init__(self, rate, burst=1):
+        self.rate, self.burst = rate, burst
+        self.tokens, self.updated = burst, time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait for a token, callers are served in the order they arrive."""
+        async with self._lock:
+            while True:
+                clock = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (clock - self.updated) * self.rate
+                )
+                self.updated = clock
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def handle_tool_calls(user_id, persona_id, tool_calls):
+    """Run a turn's tool calls concurrently, each bounded by its tool's timeout.
+
+    The timeout only starts once a call gets one of its tool's threads, a call
+    still waiting for one after as long again is given up on before it runs.
+    """
+    loop = asyncio.get_running_loop()
+
+    def failed(tool_call, error):
+        return {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "name": tool_call.function.name,
+            "content": f"Error: {error}",
+        }
+
+    async def run(tool_call):
+        tool_name = tool_call.function.name
+        tool_func = TOOL_MAPPING.get(tool_name)
+        if tool_func is None:
+            # fails on the lookup, nothing to run in a thread
+            return handle_tool_call(user_id, persona_id, tool_call)
+        started = loop.create_future()
+
+        def call():
+            clock = time.monotonic()
+            loop.call_soon_threadsafe(
+                lambda: started.done() or started.set_result(clock)
+            )
+            return handle_tool_call(user_id, persona_id, tool_call)
+
+        pending = tool_func.executor.submit(propagate(call))
+        try:
+            await asyncio.wait_for(asyncio.shield(started), tool_func.timeout)
+        except asyncio.TimeoutError:
+            # a queued call never runs once cancelled, a running one is already past this
+            if pending.cancel():
+                return failed(tool_call, f"{tool_name} is busy, try again later")
+        except asyncio.CancelledError:
+            pending.cancel()
+            raise
+        # the deadline counts from when the call started, not from when it was queued
+        remaining = await started + tool_func.timeout - time.monotonic()
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(pending), remaining)
+        except asyncio.TimeoutError:
+            # the thread finishes in the background, the model just doesn't wait for it
+            return failed(
+                tool_call, f"{tool_name} timed out after {tool_func.timeout} seconds"
+            )
+
+    return await asyncio.gather(*(run(tool_call) for tool_call in tool_calls))
+
+
 def round_to_precision(n, precision=1):
     return float(
         Decimal(str(n)).quantize(Decimal(f'1.{"0"*precision}'), rounding=ROUND_HALF_UP)
@@ -83,15 +274,47 @@ def sanitize_response(text):
     return text.lower().strip()
 
 
+def split_sentences(text):
+    """Split the complete sentences off the front of text, returning (sentences, remainder)."""
+    sentences, start = [], 0
+    for match in re.finditer(r"[.!?]+\s+", text):
+        sentence = text[start : match.end()]
+        # never split inside bracketed content, sanitize_response has to see it whole
+        if any(sentence.count(o) > sentence.count(c) for o, c in ("()", "[]", "{}")):
+            continue
+        sentences.append(sentence)
+        start = match.end()
+    return sentences, text[start:]
+
+
+async def sanitized_sentences(deltas):
+    """Sanitize a stream of text deltas, yielding each sentence as soon as it is complete."""
+    buffer = ""
+    async for delta in deltas:
+        sentences, buffer = split_sentences(buffer + delta)
+        for sentence in sentences:
+            if sentence := sanitize_response(sentence):
+                yield sentence
+    if buffer := sanitize_response(buffer):
+        yield buffer
+
+
 def is_within_wait(timestamp: str, minutes: int = 0, hours: int = 0):
+    # pendulum is imported where it's used, booting the app doesn't need it
+    import pendulum
+
     return now() - pendulum.parse(timestamp) <= pendulum.duration(
         minutes=minutes, hours=hours
     )
 
 
 def parse_time(base_time, base_tz="UTC", target_tz="UTC"):
+    import pendulum
+
     return pendulum.parse(base_time, tz=base_tz).in_timezone(target_tz)
 
 
 def now(tz="UTC"):
+    import pendulum
+
     return pendulum.now(tz)
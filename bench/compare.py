@@ -0,0 +1,105 @@
+"""Benchmark two git refs with identical stubs and load, and diff the results.
+
+    python -m bench.compare main HEAD
+    python -m bench.compare main my-branch -s telegram_text -n 500 --fail-over 10
+
+Each ref is checked out into a temporary git worktree and driven by this
+checkout's bench.run, so both sides see the same harness. Percent changes
+are reported so that positive is worse, and with --fail-over the exit
+status is non-zero when any p95 or throughput regresses by more than the
+given percentage, which makes it usable as a CI gate.
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+from bench.run import ROOT
+
+METRICS = [
+    ("p50", lambda r: r["latency_ms"]["p50"], False),
+    ("p95", lambda r: r["latency_ms"]["p95"], False),
+    ("p99", lambda r: r["latency_ms"]["p99"], False),
+    ("req/s", lambda r: r["throughput_rps"], True),
+]
+GATED = ("p95", "req/s")
+
+
+def run_ref(ref, workdir, run_args):
+    """Benchmark ref from a fresh worktree and return its results."""
+    tree = os.path.join(workdir, ref.replace("/", "_"))
+    subprocess.run(
+        ["git", "-C", ROOT, "worktree", "add", "--detach", tree, ref],
+        check=True,
+        capture_output=True,
+    )
+    output = os.path.join(workdir, f"{ref.replace('/', '_')}.json")
+    try:
+        subprocess.run(
+            [sys.executable, "-m", "bench.run", "--app-root", tree, "--json", output]
+            + run_args,
+            check=True,
+            cwd=ROOT,
+        )
+    finally:
+        subprocess.run(
+            ["git", "-C", ROOT, "worktree", "remove", "--force", tree],
+            capture_output=True,
+        )
+    with open(output) as f:
+        return json.load(f)["results"]
+
+
+def change(before, after, higher_is_better):
+    """Percent change, signed so that a positive number is a regression."""
+    if not before:
+        return 0.0
+    delta = (after - before) / before * 100
+    return -delta if higher_is_better else delta
+
+
+def compare(base, head, fail_over=None):
+    """Print a table of base vs head and return the regressions beyond fail_over."""
+    regressions = []
+    for name in base.keys() & head.keys():
+        print(f"\n{name}")
+        for metric, value, higher_is_better in METRICS:
+            before, after = value(base[name]), value(head[name])
+            pct = change(before, after, higher_is_better)
+            flag = ""
+            if fail_over is not None and metric in GATED and pct > fail_over:
+                regressions.append(f"{name} {metric} {pct:+.1f}%")
+                flag = "  <-- regression"
+            print(f"  {metric:<6} {before:>10} -> {after:>10}  {pct:+7.1f}%{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("base", help="the ref to compare against, e.g. main")
+    parser.add_argument("head", nargs="?", default="HEAD")
+    parser.add_argument(
+        "--fail-over",
+        type=float,
+        help="exit non-zero if p95 or throughput regresses by more than this percent",
+    )
+    args, run_args = parser.parse_known_args(argv)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        base = run_ref(args.base, workdir, run_args)
+        head = run_ref(args.head, workdir, run_args)
+
+    print(f"\n{args.base} -> {args.head} (positive is worse)")
+    regressions = compare(base, head, args.fail_over)
+    if regressions:
+        print("\nregressions over threshold: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
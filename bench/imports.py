@@ -0,0 +1,101 @@
+"""Measure what importing the app costs a serverless cold start, and fail if it regresses.
+
+    python -m bench.imports                  # the slowest imports, checked against the budget
+    python -m bench.imports --max-ms 250     # a tighter budget, e.g. for CI on fast machines
+
+api/index.py is imported with `python -X importtime` in fresh interpreters
+(best of --runs, the numbers are noisy) and dummy credentials, so nothing
+touches the network. The exit status is non-zero when the import takes
+longer than --max-ms, or when any of DEFERRED is imported eagerly: those
+are only needed by some requests and are loaded on first use.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+from bench.run import ROOT
+
+# heavy dependencies that must stay off the import path of api/index.py
+DEFERRED = [
+    "openai",
+    "supabase",
+    "exa_py",
+    "pinecone",
+    "httpx",
+    "requests",
+    "pendulum",
+    "psycopg",
+    "tiktoken",
+    "PIL",
+]
+# about twice what the import takes on a laptop, tight enough to catch a client built at import
+DEFAULT_BUDGET_MS = 500
+CREDENTIALS = [
+    "SUPABASE_URL",
+    "SUPABASE_SERVICE_ROLE_KEY",
+    "OPENROUTER_API_KEY",
+    "PINECONE_API_KEY",
+    "EXA_API_KEY",
+    "TELEGRAM_API_KEY",
+    "BBL_API_KEY",
+]
+
+
+def importtime(app_root):
+    """Import the app in a fresh interpreter and return {module: (self_us, cumulative_us)}."""
+    env = {
+        **os.environ,
+        **{name: "http://127.0.0.1:9" for name in CREDENTIALS},
+        "PYTHONPATH": os.pathsep.join([app_root, os.path.join(app_root, "api")]),
+    }
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import index"],
+        env=env,
+        cwd=app_root,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        if own.strip().isdigit():
+            modules.setdefault(name.strip(), (int(own), int(cumulative)))
+    return modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument(
+        "--app-root", default=ROOT, help="checkout of the app to measure"
+    )
+    args = parser.parse_args(argv)
+
+    runs = [importtime(os.path.abspath(args.app_root)) for _ in range(args.runs)]
+    best = min(runs, key=lambda modules: modules["index"][1])
+    total_ms = best["index"][1] / 1000
+
+    print(f"import index: {total_ms:.1f} ms (best of {args.runs})")
+    slowest = sorted(best.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (own, cumulative) in slowest[1 : args.top + 1]:
+        print(f"  {name:<45} {cumulative / 1000:>8.1f} ms  ({own / 1000:.1f} ms own)")
+
+    failures = [f"{name} is imported eagerly" for name in DEFERRED if name in best]
+    if total_ms > args.max_ms:
+        failures.append(f"{total_ms:.1f} ms is over the {args.max_ms:g} ms budget")
+    if failures:
+        print("\n" + "\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
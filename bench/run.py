@@ -0,0 +1,386 @@
+"""Load test the /api/responder pipeline against local stand-ins.
+
+    python -m bench.run                                  # every scenario
+    python -m bench.run -s telegram_text -n 500 -c 50    # one scenario, harder
+    python -m bench.run --json results.json              # keep the numbers for bench.compare
+
+Supabase, OpenRouter, BlueBubbles and Telegram are replaced by the stubs
+in bench/stubs.py, and Pinecone by backend.dbv's LocalStore, so a run
+needs no credentials and no network. Latencies are injected per service
+(see --latency) to keep the numbers in a realistic shape.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import itertools
+import argparse
+import tempfile
+import contextlib
+import importlib.util
+
+from bench import stubs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USERS = 50
+# a small but real jpeg header followed by noise, big enough to matter on the wire
+ATTACHMENT = b"\xff\xd8\xff\xe0" + os.urandom(256 * 1024)
+DEFAULT_LATENCY = {
+    "supabase": 15,
+    "openrouter": 250,
+    "token": 8,
+    "bluebubbles": 20,
+    "telegram": 40,
+}
+# telegram update ids are unique per bot, and redeliveries of one are dropped
+UPDATE_IDS = itertools.count(1)
+
+
+def imessage(user, i, attachment=False):
+    data = {
+        "guid": str(uuid.uuid4()),
+        "text": f"hey, what are you up to? ({i})",
+        "handle": {"address": user["imessage_address"]},
+        "chats": [{"guid": f"iMessage;-;{user['imessage_address']}"}],
+        "attachments": (
+            [{"guid": str(uuid.uuid4()), "mimeType": "image/jpeg"}]
+            if attachment
+            else []
+        ),
+        "isFromMe": False,
+    }
+    return {
+        "path": "/api/responder?channel=imessage",
+        "json": {"type": "new-message", "data": data},
+        "event": ("imessage", data["guid"]),
+        "chat": data["chats"][0]["guid"],
+    }
+
+
+def telegram(user, i, attachment=False):
+    message = {
+        "message_id": i,
+        "from": {"username": user["telegram_address"]},
+        "chat": {"id": int(user["telegram_address"][4:])},
+        "text": f"do you remember what i told you yesterday? ({i})",
+    }
+    if attachment:
+        message["photo"] = [
+            {"file_id": str(uuid.uuid4()), "file_size": len(ATTACHMENT)}
+        ]
+        message["caption"] = message.pop("text")
+    update_id = next(UPDATE_IDS)
+    return {
+        "path": "/api/responder?channel=telegram",
+        "json": {"update_id": update_id, "message": message},
+        "event": ("telegram", update_id),
+        "chat": message["chat"]["id"],
+    }
+
+
+def web(user, i, attachment=False, stream=False):
+    from werkzeug.datastructures import FileStorage
+
+    request = {
+        "path": "/api/responder?channel=web" + ("&stream=1" if stream else ""),
+        "form": {
+            "user_id": user["id"],
+            "persona_id": user["persona_id"],
+            "message": f"hi! ({i})",
+        },
+    }
+    if attachment:
+        request["files"] = {
+            "attachment": FileStorage(
+                io.BytesIO(ATTACHMENT), filename="photo.jpg", content_type="image/jpeg"
+            )
+        }
+    return request
+
+
+# scenario -> (request builder, unmemorized messages to seed per conversation)
+SCENARIOS = {
+    "imessage_text": (imessage, 0),
+    "imessage_attachment": (lambda u, i: imessage(u, i, attachment=True), 0),
+    "telegram_text": (telegram, 0),
+    "telegram_attachment": (lambda u, i: telegram(u, i, attachment=True), 0),
+    "web_text": (web, 0),
+    "web_stream": (lambda u, i: web(u, i, stream=True), 0),
+    "web_attachment": (lambda u, i: web(u, i, attachment=True), 0),
+    # every conversation is one reply away from a consolidation batch
+    "consolidation": (imessage, 29),
+}
+
+
+def start_stubs(latency):
+    services = {
+        "supabase": stubs.Supabase(latency["supabase"]),
+        "openrouter": stubs.OpenRouter(latency["openrouter"], latency["token"]),
+        "bluebubbles": stubs.BlueBubbles(latency["bluebubbles"], ATTACHMENT),
+        "telegram": stubs.Telegram(latency["telegram"], ATTACHMENT),
+    }
+    for service in services.values():
+        service.start()
+    return services
+
+
+def configure(services, workdir):
+    os.environ.update(
+        {
+            "SUPABASE_URL": services["supabase"].url,
+            "SUPABASE_SERVICE_ROLE_KEY": "bench",
+            "OPENROUTER_BASE_URL": services["openrouter"].url + "/api/v1",
+            "OPENROUTER_API_KEY": "bench",
+            "TELEGRAM_API_URL": services["telegram"].url,
+            "TELEGRAM_API_KEY": "bench",
+            "BBL_API_KEY": "bench",
+            "EXA_API_KEY": "bench",
+            "PINECONE_API_KEY": "bench",
+            "VECTOR_STORE": "local",
+            "VECTOR_STORE_PATH": os.path.join(workdir, "vectors"),
+            "JOB_QUEUE_PATH": os.path.join(workdir, "jobs.sqlite"),
+            # scenarios spread messages over conversations, waiting for bursts only adds latency
+            "COALESCE_WINDOW": "0",
+            # the stubs don't rate limit, so channel pacing would only measure itself
+            "OUTBOX_RATES": "imessage=1000,telegram=1000",
+        }
+    )
+
+
+def seed(supabase, bluebubbles_url, unmemorized):
+    supabase.tables.clear()
+    supabase.tables["server"].append({"id": 1, "url": bluebubbles_url})
+    users = []
+    for n in range(USERS):
+        profile = {
+            "id": str(uuid.uuid4()),
+            "display_name": f"user {n}",
+            "imessage_address": f"+1555{n:07d}",
+            "telegram_address": f"user{n:06d}",
+        }
+        persona = {
+            "id": str(uuid.uuid4()),
+            "user_id": profile["id"],
+            "display_name": "april",
+            "prompt": "you are april, a warm and witty companion. " * 20,
+            "temperature": 0.7,
+            "model": "bench/model",
+            "is_imessage_persona": True,
+            "is_telegram_persona": True,
+            "memory_mode": "tool",
+        }
+        supabase.tables["profiles"].append(profile)
+        supabase.tables["personas"].append(persona)
+        for i in range(unmemorized):
+            supabase.tables["messages"].append(
+                {
+                    "id": str(uuid.uuid4()),
+                    "user_id": profile["id"],
+                    "persona_id": persona["id"],
+                    "channel": "imessage",
+                    "role": "user" if i % 2 == 0 else "assistant",
+                    "content": f"message {i} about my dog max and my job at the bakery",
+                    "file_path": None,
+                    "file_description": None,
+                    "memorized": False,
+                    "created_at": stubs.now(i - unmemorized),
+                }
+            )
+        users.append({**profile, "persona_id": persona["id"]})
+    return users
+
+
+def load_app(app_root):
+    sys.path.insert(0, app_root)
+    spec = importlib.util.spec_from_file_location(
+        "bench_app", os.path.join(app_root, "api", "index.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+
+async def drive(app, build, users, requests, concurrency):
+    # refs from before webhooks were acknowledged early, or replies queued, lack these
+    inbox = getattr(sys.modules.get("backend.conversations"), "inbox", None)
+    outbox = sys.modules.get("backend.outbox")
+    client = app.test_client()
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        request = build(users[i % len(users)], i)
+        path, event, chat = (request.pop(k, None) for k in ("path", "event", "chat"))
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, **request)
+                await response.get_data()
+                # a webhook is acknowledged at once, time it until the reply is delivered
+                if inbox is not None and event is not None:
+                    await inbox.join(event)
+                if outbox is not None and chat is not None:
+                    await outbox.join(chat)
+                if response.status_code != 200:
+                    errors += 1
+            except Exception as e:
+                print(f"request {i} failed: {e!r}", file=sys.stderr)
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies, errors, time.perf_counter() - start
+
+
+def stage_breakdown(services, requests):
+    stages = {}
+    for name, service in services.items():
+        for route, timings in sorted(service.timings.items()):
+            stages[f"{name}.{route}"] = {
+                "calls_per_request": round(len(timings) / requests, 3),
+                "ms_per_request": round(sum(timings) * 1000 / requests, 2),
+            }
+    return stages
+
+
+async def run_scenario(app, services, name, requests, concurrency):
+    from backend.dbp import invalidate_conversations
+
+    build, unmemorized = SCENARIOS[name]
+    users = seed(services["supabase"], services["bluebubbles"].url, unmemorized)
+    # every scenario seeds fresh profiles under the same addresses
+    invalidate_conversations()
+    for service in services.values():
+        service.reset()
+
+    latencies, errors, elapsed = await drive(app, build, users, requests, concurrency)
+    result = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "max": round(max(latencies) * 1000, 1),
+        },
+        "stages": stage_breakdown(services, requests),
+    }
+
+    # the batches themselves are consolidated off the request path, time the worker separately
+    if unmemorized:
+        from backend.jobs import run_worker, get_queue
+
+        for service in services.values():
+            service.reset()
+        start = time.perf_counter()
+        jobs = await asyncio.to_thread(run_worker)
+        elapsed = time.perf_counter() - start
+        result["consolidation"] = {
+            "jobs": jobs,
+            "ms_per_job": round(elapsed * 1000 / max(jobs, 1), 1),
+            "depth_after": get_queue().depth(),
+            "stages": stage_breakdown(services, max(jobs, 1)),
+        }
+    return result
+
+
+async def run_all(app, services, scenarios, requests, concurrency):
+    return {
+        name: await run_scenario(app, services, name, requests, concurrency)
+        for name in scenarios
+    }
+
+
+def print_report(results):
+    for name, result in results.items():
+        latency = result["latency_ms"]
+        print(
+            f"\n{name}: {result['requests']} requests @ {result['concurrency']} concurrent, "
+            f"{result['throughput_rps']} req/s, {result['errors']} errors"
+        )
+        print(
+            f"  latency ms  p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}"
+        )
+        for stage, numbers in result["stages"].items():
+            print(
+                f"  {stage:<45} {numbers['calls_per_request']:>6} calls  {numbers['ms_per_request']:>9} ms"
+            )
+        if consolidation := result.get("consolidation"):
+            print(
+                f"  consolidation: {consolidation['jobs']} jobs, {consolidation['ms_per_job']} ms/job"
+            )
+            for stage, numbers in consolidation["stages"].items():
+                print(
+                    f"    {stage:<43} {numbers['calls_per_request']:>6} calls  {numbers['ms_per_request']:>9} ms"
+                )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="defaults to all",
+    )
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--latency",
+        default="",
+        help="per service overrides in ms, e.g. openrouter=100,supabase=5",
+    )
+    parser.add_argument(
+        "--app-root", default=ROOT, help="checkout of the app to benchmark"
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    latency = dict(DEFAULT_LATENCY)
+    for item in filter(None, args.latency.split(",")):
+        key, _, value = item.partition("=")
+        latency[key] = float(value)
+
+    services = start_stubs(latency)
+    with tempfile.TemporaryDirectory() as workdir:
+        configure(services, workdir)
+        # the app prints every request, keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = load_app(os.path.abspath(args.app_root))
+            # one event loop for every scenario, the app's async clients are bound to it
+            results = asyncio.run(
+                run_all(
+                    app,
+                    services,
+                    args.scenario or list(SCENARIOS),
+                    args.requests,
+                    args.concurrency,
+                )
+            )
+    for service in services.values():
+        service.stop()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"latency": latency, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
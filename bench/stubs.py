@@ -0,0 +1,585 @@
+"""Local stand-ins for the services behind /api/responder.
+
+Each stub is a small threaded HTTP server that sleeps for a configurable
+latency before answering and records how long every call took, so a
+benchmark run can break request time down by dependency. Pinecone has no
+stub here, the harness uses backend.dbv's LocalStore instead.
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit, parse_qsl, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections when a scenario opens dozens at once
+    request_queue_size = 128
+
+
+class Stub:
+    """A stand-in service, subclasses implement handle() and name their routes."""
+
+    name = "stub"
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.timings = defaultdict(list)
+        self._lock = threading.Lock()
+        self.server = Server(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def record(self, route, seconds):
+        with self._lock:
+            self.timings[route].append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+
+    def handle(self, method, path, query, headers, body):
+        """Return (route, status, headers, body), body may be an iterator of chunks"""
+        raise NotImplementedError("Subclasses must implement handle()")
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def dispatch(self):
+                start = time.perf_counter()
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                time.sleep(stub.latency)
+                route, status, headers, payload = stub.handle(
+                    self.command,
+                    unquote(url.path),
+                    parse_qsl(url.query, keep_blank_values=True),
+                    self.headers,
+                    body,
+                )
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                if isinstance(payload, (bytes, str)):
+                    payload = payload.encode() if isinstance(payload, str) else payload
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    if self.command != "HEAD":
+                        self.wfile.write(payload)
+                else:
+                    # stream the chunks with chunked transfer encoding
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    for chunk in payload:
+                        chunk = chunk.encode() if isinstance(chunk, str) else chunk
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                stub.record(route, time.perf_counter() - start)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = do_HEAD = dispatch
+
+        return Handler
+
+
+def json_response(route, data, status=200, headers=None):
+    return (
+        route,
+        status,
+        {"Content-Type": "application/json", **(headers or {})},
+        json.dumps(data),
+    )
+
+
+class Supabase(Stub):
+    """An in-memory PostgREST and storage subset, enough for backend.dbp and backend.jobs."""
+
+    name = "supabase"
+    defaults = {
+        "messages": lambda: {
+            "memorized": False,
+            "file_path": None,
+            "file_description": None,
+        },
+        "memory_jobs": lambda: {"status": "pending", "attempts": 0, "last_error": None},
+    }
+
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_ms)
+        self.tables = defaultdict(list)
+        self.objects = {}
+        self.rpcs = {
+            "resolve_conversation": self.resolve_conversation,
+            "claim_memory_job": self.claim_memory_job,
+            "claim_unmemorized_batch": self.claim_unmemorized_batch,
+            "save_message_and_claim": self.save_message_and_claim,
+            "acquire_conversation_lease": self.acquire_conversation_lease,
+            "release_conversation_lease": self.release_conversation_lease,
+            "bump_conversation_generation": self.bump_conversation_generation,
+            "enqueue_inbound_event": self.enqueue_inbound_event,
+            "claim_inbound_event": self.claim_inbound_event,
+        }
+        self.db_lock = threading.RLock()
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith("/storage/v1/object/"):
+            key = path[len("/storage/v1/object/") :]
+            self.objects[key] = body
+            return json_response("storage.upload", {"Key": key})
+        if path.startswith("/rest/v1/rpc/"):
+            name = path[len("/rest/v1/rpc/") :]
+            with self.db_lock:
+                result = self.rpcs[name](**json.loads(body or b"{}"))
+            return json_response(f"rpc.{name}", result)
+
+        table = path[len("/rest/v1/") :]
+        params = [
+            (k, v)
+            for k, v in query
+            if k not in ("select", "order", "limit", "on_conflict", "columns")
+        ]
+        options = dict(query)
+        prefer = headers.get("Prefer", "")
+        with self.db_lock:
+            rows = self.tables[table]
+            if method in ("GET", "HEAD"):
+                result = self.select(rows, params, options)
+            elif method == "POST":
+                result = self.insert(table, json.loads(body), options, prefer)
+            elif method == "PATCH":
+                result = self.update(rows, params, json.loads(body))
+            else:
+                result = []
+            result = [self.project(row, options.get("select", "*")) for row in result]
+        extra = {"Content-Range": f"0-{max(len(result) - 1, 0)}/{len(result)}"}
+        return json_response(f"{method.lower()}.{table}", result, headers=extra)
+
+    @staticmethod
+    def matches(row, params):
+        for column, condition in params:
+            op, _, value = condition.partition(".")
+            actual = row.get(column)
+            actual = str(actual).lower() if isinstance(actual, bool) else str(actual)
+            if op == "eq" and actual != value:
+                return False
+            if op == "neq" and actual == value:
+                return False
+            if op == "in" and actual not in value.strip("()").split(","):
+                return False
+            if op == "is" and (row.get(column) is not None) != (value != "null"):
+                return False
+            # iso timestamps in one format compare correctly as strings
+            if op in ("gt", "gte", "lt", "lte") and not {
+                "gt": actual > value,
+                "gte": actual >= value,
+                "lt": actual < value,
+                "lte": actual <= value,
+            }[op]:
+                return False
+        return True
+
+    def select(self, rows, params, options):
+        result = [row for row in rows if self.matches(row, params)]
+        if order := options.get("order"):
+            column, _, direction = order.partition(".")
+            result.sort(
+                key=lambda r: r.get(column) or "", reverse=direction.startswith("desc")
+            )
+        if limit := options.get("limit"):
+            result = result[: int(limit)]
+        return result
+
+    def insert(self, table, data, options, prefer):
+        created = []
+        for row in data if isinstance(data, list) else [data]:
+            row = {**self.defaults.get(table, dict)(), **row}
+            row.setdefault("id", str(uuid.uuid4()))
+            row.setdefault("created_at", now())
+            keys = options.get("on_conflict", "id").split(",")
+            existing = next(
+                (
+                    r
+                    for r in self.tables[table]
+                    if all(r.get(k) == row.get(k) for k in keys)
+                ),
+                None,
+            )
+            if existing is not None:
+                if "merge-duplicates" in prefer:
+                    existing.update(row)
+                    created.append(existing)
+                continue
+            self.tables[table].append(row)
+            created.append(row)
+        return created
+
+    def update(self, rows, params, data):
+        updated = [row for row in rows if self.matches(row, params)]
+        for row in updated:
+            row.update(data)
+        return updated
+
+    @staticmethod
+    def project(row, select):
+        if select == "*":
+            return dict(row)
+        return {c: row.get(c) for c in select.split(",")}
+
+    def resolve_conversation(self, p_channel, p_address, p_persona_id=None):
+        column = {"telegram": "telegram_address", "imessage": "imessage_address"}.get(
+            p_channel, "id"
+        )
+        profile = next(
+            (p for p in self.tables["profiles"] if p.get(column) == p_address), None
+        )
+        if profile is None:
+            return None
+        flag = {
+            "telegram": "is_telegram_persona",
+            "imessage": "is_imessage_persona",
+        }.get(p_channel)
+        persona = next(
+            (
+                p
+                for p in self.tables["personas"]
+                if p["user_id"] == profile["id"]
+                and (p.get(flag) if flag else p["id"] == p_persona_id)
+            ),
+            None,
+        )
+        return {"profile": profile, "persona": persona}
+
+    def claim_memory_job(self, lease_seconds=300, max_attempts=5):
+        for j in self.tables["memory_jobs"]:
+            if (
+                j["status"] == "running"
+                and j.get("run_after", "") <= now()
+                and j["attempts"] >= max_attempts
+            ):
+                j.update(
+                    status="failed",
+                    last_error=f"lease expired on attempt {j['attempts']}",
+                )
+        runnable = [
+            j
+            for j in self.tables["memory_jobs"]
+            if j["status"] in ("pending", "running")
+            and j.get("run_after", "") <= now()
+            and j["attempts"] < max_attempts
+        ]
+        if not runnable:
+            return []
+        job = min(runnable, key=lambda j: j.get("run_after", ""))
+        job.update(
+            status="running", attempts=job["attempts"] + 1, run_after=now(lease_seconds)
+        )
+        return [dict(job)]
+
+    def enqueue_inbound_event(
+        self, p_channel, p_event_id, p_payload, p_lease_seconds=300
+    ):
+        events = self.tables["inbound_events"]
+        if any(
+            e["channel"] == p_channel and e["event_id"] == p_event_id for e in events
+        ):
+            return False
+        events.append(
+            {
+                "channel": p_channel,
+                "event_id": p_event_id,
+                "payload": p_payload,
+                "status": "running",
+                "attempts": 1,
+                "last_error": None,
+                "run_after": now(p_lease_seconds),
+                "created_at": now(),
+            }
+        )
+        return True
+
+    def claim_inbound_event(self, lease_seconds=300, max_attempts=3):
+        runnable = [
+            e
+            for e in self.tables["inbound_events"]
+            if e["status"] in ("pending", "running")
+            and e["run_after"] <= now()
+            and e["attempts"] < max_attempts
+        ]
+        if not runnable:
+            return []
+        event = min(runnable, key=lambda e: e["run_after"])
+        event.update(
+            status="running",
+            attempts=event["attempts"] + 1,
+            run_after=now(lease_seconds),
+        )
+        return [dict(event)]
+
+    def claim_unmemorized_batch(
+        self, p_user_id, p_persona_id, p_channel, p_batch_size=30
+    ):
+        batch = sorted(
+            (
+                m
+                for m in self.tables["messages"]
+                if m["user_id"] == p_user_id
+                and m["persona_id"] == p_persona_id
+                and m["channel"] == p_channel
+                and not m["memorized"]
+            ),
+            key=lambda m: m["created_at"],
+        )[:p_batch_size]
+        if len(batch) < p_batch_size:
+            return None
+        for m in batch:
+            m["memorized"] = True
+        return [m["id"] for m in batch]
+
+    def save_message_and_claim(
+        self, p_user_id, p_persona_id, p_channel, p_role, p_content, p_batch_size=30
+    ):
+        message = {
+            "user_id": p_user_id,
+            "persona_id": p_persona_id,
+            "channel": p_channel,
+            "role": p_role,
+            "content": p_content,
+        }
+        self.insert("messages", message, {}, "")
+        return self.claim_unmemorized_batch(
+            p_user_id, p_persona_id, p_channel, p_batch_size
+        )
+
+    def acquire_conversation_lease(self, p_key, p_holder, p_seconds=120):
+        lease = next(
+            (l for l in self.tables["conversation_leases"] if l["key"] == p_key), None
+        )
+        if lease is None:
+            lease = {"key": p_key, "generation": 0}
+            self.tables["conversation_leases"].append(lease)
+        elif lease["expires_at"] >= now() and lease["holder"] != p_holder:
+            return None
+        lease.update(holder=p_holder, expires_at=now(p_seconds))
+        return True
+
+    def release_conversation_lease(self, p_key, p_holder):
+        for lease in self.tables["conversation_leases"]:
+            if lease["key"] == p_key and lease["holder"] == p_holder:
+                lease.update(holder=None, expires_at="")
+
+    def bump_conversation_generation(self, p_key):
+        lease = next(
+            (l for l in self.tables["conversation_leases"] if l["key"] == p_key), None
+        )
+        if lease is None:
+            lease = {"key": p_key, "holder": None, "expires_at": "", "generation": 0}
+            self.tables["conversation_leases"].append(lease)
+        lease["generation"] += 1
+        return lease["generation"]
+
+
+def now(offset_seconds=0):
+    return (
+        time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(time.time() + offset_seconds))
+        + "+00:00"
+    )
+
+
+class OpenRouter(Stub):
+    """Chat completions with a fixed time to first token and a per token delay."""
+
+    name = "openrouter"
+    reply = (
+        "hey you! i was just thinking about you. how was your day? tell me everything."
+    )
+
+    def __init__(self, latency_ms=0, token_ms=0):
+        super().__init__(latency_ms)
+        self.token_delay = token_ms / 1000
+        self.prefixes = set()
+
+    def cached_tokens(self, request):
+        """Pretend the tools and leading system messages were cached if we've seen them before."""
+        prefix = [request.get("tools")]
+        for m in request["messages"]:
+            if m.get("role") != "system":
+                break
+            prefix.append(m)
+        key = hash(json.dumps(prefix, sort_keys=True))
+        with self._lock:
+            hit = key in self.prefixes
+            self.prefixes.add(key)
+        return 400 if hit else 0
+
+    def handle(self, method, path, query, headers, body):
+        request = json.loads(body)
+        messages = request["messages"]
+        if schema := request.get("response_format", {}).get("json_schema"):
+            content = json.dumps(example(schema["schema"]))
+            return json_response(f"structured.{schema['name']}", completion(content))
+        if any(
+            part.get("type") == "image_url"
+            for m in messages
+            if isinstance(m.get("content"), list)
+            for part in m["content"]
+        ):
+            return json_response("vision", completion("a photo of a dog on a beach."))
+
+        # ask for memories once when the user mentions them, to exercise the tool path
+        tool_call = None
+        last = messages[-1]
+        if (
+            last.get("role") == "user"
+            and "remember" in (last.get("content") or "")
+            and any(
+                t["function"]["name"] == "get_facts" for t in request.get("tools", [])
+            )
+        ):
+            arguments = json.dumps({"user_query": last["content"], "agent_query": ""})
+            tool_call = {
+                "id": "call_0",
+                "type": "function",
+                "function": {"name": "get_facts", "arguments": arguments},
+            }
+
+        cached = self.cached_tokens(request)
+        if not request.get("stream"):
+            time.sleep(self.token_delay * len(self.reply.split()))
+            return json_response(
+                "chat", completion(None if tool_call else self.reply, tool_call, cached)
+            )
+        return (
+            "chat.stream",
+            200,
+            {"Content-Type": "text/event-stream"},
+            self.stream(tool_call, cached),
+        )
+
+    def stream(self, tool_call, cached=0):
+        if tool_call:
+            delta = {"tool_calls": [{"index": 0, **tool_call}]}
+            yield sse(chunk(delta))
+        else:
+            for word in self.reply.split(" "):
+                time.sleep(self.token_delay)
+                yield sse(chunk({"content": word + " "}))
+        finish_reason = "tool_calls" if tool_call else "stop"
+        yield sse(chunk({}, finish_reason, cached))
+        yield "data: [DONE]\n\n"
+
+
+def sse(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def usage(cached=0):
+    return {
+        "prompt_tokens": 500,
+        "completion_tokens": 20,
+        "total_tokens": 520,
+        "prompt_tokens_details": {"cached_tokens": cached},
+    }
+
+
+def completion(content, tool_call=None, cached=0):
+    message = {"role": "assistant", "content": content}
+    if tool_call:
+        message["tool_calls"] = [tool_call]
+    return {
+        "id": "gen-bench",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "bench",
+        "choices": [
+            {
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if tool_call else "stop",
+            }
+        ],
+        "usage": usage(cached),
+    }
+
+
+def chunk(delta, finish_reason=None, cached=0):
+    return {
+        "id": "gen-bench",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "bench",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        **({"usage": usage(cached)} if finish_reason else {}),
+    }
+
+
+def example(schema):
+    """Build a plausible instance of a JSON schema, for structured output calls."""
+    kind = schema.get("type")
+    if kind == "object":
+        return {k: example(v) for k, v in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [example(schema.get("items", {})) for _ in range(random.randint(2, 4))]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return False
+    return f"user mentioned fact number {random.randint(0, 10_000)} during the conversation."
+
+
+class BlueBubbles(Stub):
+    name = "bluebubbles"
+
+    def __init__(self, latency_ms=0, attachment=b""):
+        super().__init__(latency_ms)
+        self.attachment = attachment
+
+    def handle(self, method, path, query, headers, body):
+        if path.endswith("/download"):
+            return (
+                "attachment.download",
+                200,
+                {"Content-Type": "image/jpeg"},
+                self.attachment,
+            )
+        if path.endswith("/typing"):
+            return json_response("typing", {"status": 200})
+        return json_response("message.text", {"status": 200, "data": {}})
+
+
+class Telegram(Stub):
+    name = "telegram"
+
+    def __init__(self, latency_ms=0, attachment=b""):
+        super().__init__(latency_ms)
+        self.attachment = attachment
+
+    def handle(self, method, path, query, headers, body):
+        if path.startswith("/file/"):
+            return (
+                "file.download",
+                200,
+                {"Content-Type": "image/jpeg"},
+                self.attachment,
+            )
+        method_name = re.sub(r"^/bot[^/]*/", "", path)
+        result = {"file_path": "photos/bench.jpg"} if method_name == "getFile" else {}
+        return json_response(method_name, {"ok": True, "result": result})
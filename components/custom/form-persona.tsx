@@ -45,6 +45,13 @@ import {
 } from '@/components/ui/form'
 import { Input } from '@/components/ui/input'
 import { Textarea } from '@/components/ui/textarea'
+import {
+  Select,
+  SelectContent,
+  SelectItem,
+  SelectTrigger,
+  SelectValue,
+} from '@/components/ui/select'
 import { MessagingPlatformField } from '@/components/ui/messaging-platform-field'
 
 const messagingPlatformValueSchema = z.object({
@@ -60,6 +67,7 @@ const personaFormSchema = z.object({
     .number()
     .min(0, 'Temperature must be at least 0')
     .max(2, 'Temperature must be at most 2'),
+  memory_mode: z.enum(['tool', 'prefetch', 'hybrid']),
   messaging_platform: messagingPlatformValueSchema,
 })
 
@@ -152,6 +160,7 @@ export function PersonaForm({
       prompt: persona?.prompt || '',
       model: persona?.model || '',
       temperature: persona?.temperature || 0.7,
+      memory_mode: persona?.memory_mode || ('tool' as const),
       messaging_platform: {
         is_imessage_persona: persona?.is_imessage_persona ?? freshProfile,
         is_telegram_persona: persona?.is_telegram_persona ?? freshProfile,
@@ -189,6 +198,7 @@ export function PersonaForm({
         prompt: data.prompt,
         model: data.model,
         temperature: data.temperature,
+        memory_mode: data.memory_mode,
         is_imessage_persona: data.messaging_platform.is_imessage_persona,
         is_telegram_persona: data.messaging_platform.is_telegram_persona,
       })
@@ -281,7 +291,8 @@ export function PersonaForm({
                     </FormItem>
                   )}
                 />
-                <FormField
+                <div className="grid grid-cols-2 gap-4">
+                  <FormField
                     control={form.control}
                     name="temperature"
                     render={({ field }) => (
@@ -294,6 +305,29 @@ export function PersonaForm({
                       </FormItem>
                     )}
                   />
+                  <FormField
+                    control={form.control}
+                    name="memory_mode"
+                    render={({ field }) => (
+                      <FormItem>
+                        <FormLabel>Memory</FormLabel>
+                        <Select value={field.value} onValueChange={field.onChange}>
+                          <FormControl>
+                            <SelectTrigger className="w-full">
+                              <SelectValue />
+                            </SelectTrigger>
+                          </FormControl>
+                          <SelectContent>
+                            <SelectItem value="tool">Recall when needed</SelectItem>
+                            <SelectItem value="prefetch">Always recall</SelectItem>
+                            <SelectItem value="hybrid">Both</SelectItem>
+                          </SelectContent>
+                        </Select>
+                        <FormMessage />
+                      </FormItem>
+                    )}
+                  />
+                </div>
                 <FormField
                   control={form.control}
                   name="messaging_platform"
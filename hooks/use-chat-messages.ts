@@ -2,6 +2,9 @@ import { Message } from '@/lib/types'
 import { useState } from 'react'
 import { toast } from 'sonner'
 
+// an error the backend explained, shown to the user as it is
+class ReplyError extends Error {}
+
 // const API_URL = process.env.NODE_ENV === 'development' ? 'http://localhost:3001/api/frontend' : 'https://april-python.vercel.app/api/frontend';
 
 export function useChatMessages({
@@ -46,23 +49,61 @@ export function useChatMessages({
     }
 
     try {
-      const response = await fetch(`/api/responder?channel=web`, {
+      const response = await fetch(`/api/responder?channel=web&stream=1`, {
         method: 'POST',
         credentials: 'include',
         body: formData,
       })
-      const result = await response.json()
+      // errors, and anything answered without streaming, come back as plain JSON
+      const contentType = response.headers.get('content-type') ?? ''
+      if (!response.ok || !contentType.includes('text/event-stream')) {
+        const result = await response.json().catch(() => null)
+        if (!response.ok || result?.status !== 200) {
+          throw typeof result?.message === 'string'
+            ? new ReplyError(result.message)
+            : new Error(`Request failed with status ${response.status}`)
+        }
+        setMessages((prev) => [
+          ...prev,
+          { ...result.message, created_at: new Date().toISOString() },
+        ])
+        return
+      }
+      if (!response.body) throw new Error('Empty response')
+
+      // the reply streams in as server sent events, one sentence at a time
       setMessages((prev) => [
         ...prev,
-        {
-          role: 'assistant',
-          content: result.message.content,
-          created_at: new Date().toISOString(),
-        },
+        { role: 'assistant', content: '', created_at: new Date().toISOString() },
       ])
+      const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+      let buffer = ''
+      while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
+        buffer += value
+        const events = buffer.split('\n\n')
+        buffer = events.pop() ?? ''
+        for (const event of events) {
+          const data = event.replace(/^data: /, '')
+          if (data === '[DONE]') continue
+          const { content: sentence, error } = JSON.parse(data)
+          if (error) throw new ReplyError(error)
+          setMessages((prev) => {
+            const last = prev[prev.length - 1]
+            const content = last.content ? `${last.content} ${sentence}` : sentence
+            return [...prev.slice(0, -1), { ...last, content }]
+          })
+        }
+      }
     } catch (err: any) {
       console.error('Send message error:', err)
-      toast.error(`Failed to connect to April.`, {
+      // drop the reply bubble if nothing made it into it
+      setMessages((prev) => {
+        const last = prev[prev.length - 1]
+        return last?.role === 'assistant' && !last.content ? prev.slice(0, -1) : prev
+      })
+      toast.error(err instanceof ReplyError ? err.message : `Failed to connect to April.`, {
         description: 'Please contact support if the issue persists.',
       })
     } finally {
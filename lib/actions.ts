@@ -6,6 +6,10 @@ import { Profile, Persona } from '@/lib/types'
 import { createClient } from '@/lib/supabase/server'
 
 const SIGNED_URL_EXPIRY_SECONDS = 3600 // one hour
+const BACKEND_URL =
+  process.env.NODE_ENV === 'development'
+    ? 'http://127.0.0.1:5328'
+    : `https://${process.env.VERCEL_URL}`
 
 // supabase actions //
 async function getSupabaseUser() {
@@ -19,10 +23,28 @@ async function getSupabaseUser() {
   return { supabase, user }
 }
 
+// tell the python backend to drop its cached profile/persona lookups for this user
+async function invalidateBackendCache(profileId: string) {
+  try {
+    await fetch(`${BACKEND_URL}/api/cache`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+        Authorization: `Bearer ${process.env.SUPABASE_SERVICE_ROLE_KEY}`,
+      },
+      body: JSON.stringify({ profile_id: profileId }),
+    })
+  } catch (error) {
+    // the cache entries expire on their own, so don't fail the save
+    console.error('Error invalidating backend cache:', error)
+  }
+}
+
 export async function saveProfile(profile: Profile) {
   const { supabase } = await getSupabaseUser()
   const { data, error } = await supabase.from('profiles').upsert(profile).select().single()
   if (error) throw new Error(error.message)
+  await invalidateBackendCache(data.id)
   return data
 }
 
@@ -39,6 +61,7 @@ export async function savePersona(persona: Persona) {
   
   const { data, error } = await supabase.from('personas').upsert(persona).select().single()
   if (error) throw new Error(error.message)
+  await invalidateBackendCache(user.id)
   return data
 }
 
@@ -46,6 +69,7 @@ export async function deletePersona(id: string) {
   const { supabase, user } = await getSupabaseUser()
   const { error } = await supabase.from('personas').delete().eq('id', id).eq('user_id', user.id)
   if (error) return { success: false, error: error.message }
+  await invalidateBackendCache(user.id)
   return { success: true }
 }
 
@@ -29,7 +29,8 @@ create table public.personas (
   temperature           float4      not null,
   model                 text       not null,
   is_imessage_persona   boolean    default false,
-  is_telegram_persona   boolean    default false
+  is_telegram_persona   boolean    default false,
+  memory_mode           text       not null default 'tool' check (memory_mode in ('tool', 'prefetch', 'hybrid'))
 );
 create index on public.personas(user_id);
 create unique index idx_unique_imessage_persona on public.personas(user_id) where is_imessage_persona = true;
@@ -42,6 +43,42 @@ create policy "user owns persona"
   using ( user_id = auth.uid() )
   with check ( user_id = auth.uid() );
 
+-- resolves the profile for an inbound (channel, address) and its persona in a single round trip
+create or replace function public.resolve_conversation(p_channel text, p_address text, p_persona_id text default null)
+returns json
+language plpgsql
+stable
+as $$
+declare
+  pr public.profiles;
+  pe public.personas;
+begin
+  if p_channel = 'telegram' then
+    select * into pr from public.profiles where telegram_address = p_address;
+  elsif p_channel = 'imessage' then
+    select * into pr from public.profiles where imessage_address = p_address;
+  else
+    select * into pr from public.profiles where id = p_address::uuid;
+  end if;
+  if pr.id is null then
+    return null;
+  end if;
+
+  if p_channel = 'telegram' then
+    select * into pe from public.personas where user_id = pr.id and is_telegram_persona;
+  elsif p_channel = 'imessage' then
+    select * into pe from public.personas where user_id = pr.id and is_imessage_persona;
+  else
+    select * into pe from public.personas where user_id = pr.id and id::text = p_persona_id;
+  end if;
+
+  return json_build_object(
+    'profile', to_json(pr),
+    'persona', case when pe.id is null then null else to_json(pe) end
+  );
+end;
+$$;
+
 
 -- 4) messages
 create table public.messages (
@@ -58,6 +95,8 @@ create table public.messages (
 );
 -- compound index to fetch a persona's history in time-desc order:
 create index on public.messages (persona_id, created_at desc);
+-- partial index over just the messages still waiting to be consolidated, so counting and claiming a batch stays cheap
+create index on public.messages (user_id, persona_id, channel, created_at) where not memorized;
 
 alter table public.messages enable row level security;
 create policy "user owns messages"
@@ -84,7 +123,85 @@ create table public.server (
 );
 alter table public.server enable row level security;
 
--- 5) attachments storage bucket
+-- 5) memory consolidation jobs (one per batch of messages, keyed on the batch's last message id)
+create table public.memory_jobs (
+  id            uuid        primary key,
+  user_id       uuid        not null references public.profiles(id) on delete cascade,
+  persona_id    uuid        not null references public.personas(id) on delete cascade,
+  channel       text        not null,
+  message_ids   uuid[]      not null,
+  status        text        not null default 'pending', -- pending | running | done | failed
+  attempts      int         not null default 0,
+  last_error    text,
+  run_after     timestamptz not null default now(),
+  created_at    timestamptz not null default now()
+);
+create index on public.memory_jobs (status, run_after);
+alter table public.memory_jobs enable row level security;
+
+-- leases the next runnable job, running jobs whose lease expired are picked up again,
+-- or given up on if that was their last attempt
+create or replace function public.claim_memory_job(lease_seconds int default 300, max_attempts int default 5)
+returns setof public.memory_jobs
+language sql
+as $$
+  update public.memory_jobs
+  set status = 'failed', last_error = 'lease expired on attempt ' || attempts
+  where status = 'running' and run_after <= now() and attempts >= max_attempts;
+
+  update public.memory_jobs
+  set status = 'running', attempts = attempts + 1, run_after = now() + make_interval(secs => lease_seconds)
+  where id = (
+    select id from public.memory_jobs
+    where status in ('pending', 'running') and run_after <= now() and attempts < max_attempts
+    order by run_after
+    limit 1
+    for update skip locked
+  )
+  returning *;
+$$;
+
+-- 6) rolling conversation summaries (extended by the memory worker with each consolidated batch)
+create table public.conversation_summaries (
+  user_id             uuid        not null references public.profiles(id) on delete cascade,
+  persona_id          uuid        not null references public.personas(id) on delete cascade,
+  channel             text        not null,
+  summary             text        not null,
+  summarized_through  timestamptz not null, -- created_at of the newest message folded into the summary
+  updated_at          timestamptz not null default now(),
+  primary key (user_id, persona_id, channel)
+);
+
+alter table public.conversation_summaries enable row level security;
+create policy "user owns summaries"
+  on public.conversation_summaries
+  for all
+  using ( user_id = auth.uid() )
+  with check ( user_id = auth.uid() );
+
+-- 7) internet search answers shared by every backend instance (service role only, keyed on the normalized query)
+create table public.search_cache (
+  key          text        primary key,
+  answer       text        not null,
+  query_class  text        not null,
+  expires_at   timestamptz not null,
+  created_at   timestamptz not null default now()
+);
+create index on public.search_cache (expires_at);
+alter table public.search_cache enable row level security;
+
+-- 8) attachments seen before, so a forwarded photo is neither uploaded again by the same user nor described twice
+create table public.attachments (
+  hash         text        not null, -- sha256 of the bytes
+  user_id      uuid        not null references public.profiles(id) on delete cascade,
+  file_path    text        not null,
+  description  text,
+  created_at   timestamptz not null default now(),
+  primary key (hash, user_id)
+);
+alter table public.attachments enable row level security;
+
+-- 9) attachments storage bucket
 insert into storage.buckets (id, name, public)
 values ('attachments', 'attachments', false);
 
@@ -103,3 +220,148 @@ create policy "user can update own attachments" on storage.objects for update wi
 create policy "user can delete own attachments" on storage.objects for delete using (
   bucket_id = 'attachments' and auth.uid() = owner
 );
+
+-- 10) per-conversation ordering and coalescing across backend instances (service role only, keyed on channel:user:persona)
+create table public.conversation_leases (
+  key         text        primary key,
+  holder      uuid,                                    -- null while no one holds the lease
+  expires_at  timestamptz not null default '-infinity',
+  generation  bigint      not null default 0           -- inbound messages so far, the newest of a burst replies
+);
+alter table public.conversation_leases enable row level security;
+
+-- takes the lease if it is free, expired or already held by p_holder (advisory locks don't survive postgrest's pooled sessions)
+create or replace function public.acquire_conversation_lease(p_key text, p_holder uuid, p_seconds int default 120)
+returns boolean
+language sql
+as $$
+  insert into public.conversation_leases (key, holder, expires_at)
+  values (p_key, p_holder, now() + make_interval(secs => p_seconds))
+  on conflict (key) do update
+    set holder = excluded.holder, expires_at = excluded.expires_at
+    where conversation_leases.expires_at < now() or conversation_leases.holder = excluded.holder
+  returning true;
+$$;
+
+-- the row is kept for its generation
+create or replace function public.release_conversation_lease(p_key text, p_holder uuid)
+returns void
+language sql
+as $$
+  update public.conversation_leases set holder = null, expires_at = '-infinity'
+  where key = p_key and holder = p_holder;
+$$;
+
+-- counts an inbound message on a conversation and returns the count, see backend.conversations.Bursts
+create or replace function public.bump_conversation_generation(p_key text)
+returns bigint
+language sql
+as $$
+  insert into public.conversation_leases (key, generation)
+  values (p_key, 1)
+  on conflict (key) do update set generation = conversation_leases.generation + 1
+  returning generation;
+$$;
+
+-- marks the oldest full batch of unmemorized messages as memorized and returns its ids, oldest first,
+-- or null while fewer than p_batch_size are waiting, concurrent callers never get overlapping batches
+create or replace function public.claim_unmemorized_batch(p_user_id uuid, p_persona_id uuid, p_channel text, p_batch_size int default 30)
+returns uuid[]
+language plpgsql
+as $$
+declare
+  ids uuid[];
+begin
+  select array_agg(id order by created_at) into ids
+  from (
+    select id, created_at from public.messages
+    where user_id = p_user_id and persona_id = p_persona_id and channel = p_channel and not memorized
+    order by created_at
+    limit p_batch_size
+    for update skip locked
+  ) batch;
+  if coalesce(array_length(ids, 1), 0) < p_batch_size then
+    return null;
+  end if;
+  update public.messages set memorized = true where id = any(ids);
+  return ids;
+end;
+$$;
+
+-- inserts an assistant message and, once p_batch_size messages are waiting, claims them in the same round trip
+create or replace function public.save_message_and_claim(
+  p_user_id uuid, p_persona_id uuid, p_channel text, p_role text, p_content text, p_batch_size int default 30
+)
+returns uuid[]
+language plpgsql
+as $$
+begin
+  insert into public.messages (user_id, persona_id, channel, role, content)
+  values (p_user_id, p_persona_id, p_channel, p_role, p_content);
+  if (
+    select count(*) from (
+      select 1 from public.messages
+      where user_id = p_user_id and persona_id = p_persona_id and channel = p_channel and not memorized
+      limit p_batch_size
+    ) waiting
+  ) < p_batch_size then
+    return null;
+  end if;
+  return public.claim_unmemorized_batch(p_user_id, p_persona_id, p_channel, p_batch_size);
+end;
+$$;
+
+
+-- 11) inbound webhook events, stored before they are acknowledged so none is lost or answered twice (service role only)
+create table public.inbound_events (
+  channel     text        not null,
+  event_id    text        not null, -- telegram's update_id or bluebubbles' message guid, redeliveries share it
+  payload     jsonb       not null,
+  status      text        not null default 'running', -- running | pending | done | failed
+  attempts    int         not null default 1,
+  last_error  text,
+  run_after   timestamptz not null default now(), -- when the lease or the backoff runs out
+  created_at  timestamptz not null default now(),
+  primary key (channel, event_id)
+);
+create index on public.inbound_events (status, run_after);
+alter table public.inbound_events enable row level security;
+
+-- stores an event leased to the instance that received it, or returns false if it was stored before
+create or replace function public.enqueue_inbound_event(p_channel text, p_event_id text, p_payload jsonb, p_lease_seconds int default 300)
+returns boolean
+language sql
+as $$
+  with inserted as (
+    insert into public.inbound_events (channel, event_id, payload, run_after)
+    values (p_channel, p_event_id, p_payload, now() + make_interval(secs => p_lease_seconds))
+    on conflict (channel, event_id) do nothing
+    returning 1
+  )
+  select exists (select 1 from inserted);
+$$;
+
+-- leases the next event whose lease or backoff ran out, giving up on those out of attempts,
+-- answered events are forgotten after a day, long after any redelivery, and expired search answers with them
+create or replace function public.claim_inbound_event(lease_seconds int default 300, max_attempts int default 3)
+returns setof public.inbound_events
+language sql
+as $$
+  delete from public.inbound_events where status = 'done' and created_at < now() - interval '1 day';
+  delete from public.search_cache where expires_at < now();
+
+  update public.inbound_events
+  set status = 'failed', last_error = 'lease expired on attempt ' || attempts
+  where status = 'running' and run_after <= now() and attempts >= max_attempts;
+
+  update public.inbound_events
+  set status = 'running', attempts = attempts + 1, run_after = now() + make_interval(secs => lease_seconds)
+  where (channel, event_id) = (
+    select channel, event_id from public.inbound_events
+    where status in ('pending', 'running') and run_after <= now() and attempts < max_attempts
+    order by run_after
+    limit 1
+    for update skip locked
+  )
+  returning *;
+$$;
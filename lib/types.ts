@@ -16,6 +16,7 @@ export type Persona = {
   model: string
   is_imessage_persona: boolean
   is_telegram_persona: boolean
+  memory_mode: 'tool' | 'prefetch' | 'hybrid'
 }
 
 export type Message = {
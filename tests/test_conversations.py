@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from backend.conversations import Bursts
+
+KEY = ("telegram", "u1", "p1")
+
+
+@pytest.fixture(autouse=True)
+def local(monkeypatch):
+    monkeypatch.delenv("CONVERSATION_LOCK", raising=False)
+
+
+def test_a_burst_gets_one_reply():
+    bursts, replies = Bursts(window=0.05), []
+
+    async def message(i):
+        await asyncio.sleep(0.01 * i)
+        generation = await bursts.settle(KEY)
+        if generation is None:
+            return False
+
+        async def reply():
+            replies.append(i)
+
+        return await bursts.reply(KEY, generation, reply())
+
+    async def main():
+        return await asyncio.gather(*(message(i) for i in range(5)))
+
+    assert asyncio.run(main()) == [False, False, False, False, True]
+    # the last message answers the whole burst
+    assert replies == [4]
+    assert not bursts._latest and not bursts._replies
+
+
+def test_a_message_mid_reply_cancels_the_stale_one():
+    bursts, events = Bursts(window=0.01), []
+
+    async def message(name, generating):
+        generation = await bursts.settle(KEY)
+
+        async def reply():
+            events.append(f"{name} started")
+            await asyncio.sleep(generating)
+            events.append(f"{name} sent")
+
+        return await bursts.reply(KEY, generation, reply())
+
+    async def main():
+        first = asyncio.ensure_future(message("first", 1))
+        # arrives after the first settled, while its reply is generating
+        await asyncio.sleep(0.05)
+        second = await message("second", 0)
+        return await first, second
+
+    assert asyncio.run(main()) == (False, True)
+    assert events == ["first started", "second started", "second sent"]
@@ -0,0 +1,71 @@
+import multiprocessing
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from backend.dbv import HashingEmbedder, LocalStore
+
+
+def record(id, text):
+    return {"id": id, "text": text, "timestamp": "2025-01-01T00:00:00Z"}
+
+
+def test_reader_sees_upserts_from_another_store(tmp_path):
+    # the worker and the responder are separate processes, each with its own store
+    reader = LocalStore(str(tmp_path), HashingEmbedder())
+    writer = LocalStore(str(tmp_path), HashingEmbedder())
+
+    # read first, while the namespace is still empty
+    assert reader.query("memories-user", "u1", "dog", 5, ["text"]) == []
+
+    writer.upsert("memories-user", "u1", [record("a", "my dog is called max")])
+    hits = reader.query("memories-user", "u1", "dog max", 5, ["text"])
+    assert [hit["_id"] for hit in hits] == ["a"]
+
+    writer.upsert(
+        "memories-user",
+        "u1",
+        [record("a", "my dog is called rex"), record("b", "i work at the bakery")],
+    )
+    hits = reader.query("memories-user", "u1", "bakery", 5, ["text"])
+    assert {hit["_id"] for hit in hits} == {"a", "b"}
+    assert hits[0]["_id"] == "b"
+    texts = {hit["_id"]: hit["fields"]["text"] for hit in hits}
+    assert texts["a"] == "my dog is called rex"
+
+
+def test_upsert_keeps_records_written_by_another_store(tmp_path):
+    first = LocalStore(str(tmp_path), HashingEmbedder())
+    second = LocalStore(str(tmp_path), HashingEmbedder())
+
+    first.upsert("memories-agent", "u1", [record("a", "likes tea")])
+    second.upsert("memories-agent", "u1", [record("b", "likes coffee")])
+    first.upsert("memories-agent", "u1", [record("c", "likes juice")])
+
+    hits = second.query("memories-agent", "u1", "likes", 5, ["text"])
+    assert {hit["_id"] for hit in hits} == {"a", "b", "c"}
+
+
+def upsert_many(path, worker):
+    store = LocalStore(path, HashingEmbedder())
+    for i in range(10):
+        store.upsert("memories-user", "u1", [record(f"{worker}_{i}", f"fact {i}")])
+
+
+def test_concurrent_upserts_from_other_processes_are_all_kept(tmp_path):
+    # the worker and every responder instance may upsert the same namespace at once
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=upsert_many, args=(str(tmp_path), worker))
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    store = LocalStore(str(tmp_path), HashingEmbedder())
+    hits = store.query("memories-user", "u1", "fact", 100, ["text"])
+    assert len(hits) == 40
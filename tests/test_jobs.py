@@ -0,0 +1,84 @@
+import pytest
+
+from backend import jobs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(jobs.time, "time", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return jobs.SQLiteQueue(str(tmp_path / "jobs.sqlite"))
+
+
+def enqueue(queue, *message_ids):
+    return queue.enqueue("user", "persona", "imessage", list(message_ids))
+
+
+def test_enqueue_is_idempotent_on_the_last_message(queue):
+    assert enqueue(queue, "a", "b")
+    assert not enqueue(queue, "a", "b")
+    assert queue.depth() == {"pending": 1, "running": 0, "failed": 0}
+
+
+def test_claim_leases_the_oldest_job_once(queue, clock):
+    enqueue(queue, "a")
+    clock[0] += 1
+    enqueue(queue, "b")
+    job = queue.claim()
+    assert (job["id"], job["attempts"], job["message_ids"]) == ("a", 1, ["a"])
+    assert queue.claim()["id"] == "b"
+    assert queue.claim() is None
+    assert queue.depth()["running"] == 2
+
+
+def test_complete_removes_the_job(queue):
+    enqueue(queue, "a")
+    queue.complete(queue.claim()["id"])
+    assert queue.claim() is None
+    assert queue.depth() == {"pending": 0, "running": 0, "failed": 0}
+
+
+def test_failed_job_is_retried_after_backoff(queue, clock):
+    enqueue(queue, "a")
+    queue.fail(queue.claim(), RuntimeError("boom"))
+    assert queue.claim() is None
+    clock[0] += queue.backoff(1)
+    job = queue.claim()
+    assert job["attempts"] == 2 and job["last_error"] == "boom"
+
+
+def test_job_fails_for_good_after_max_attempts(queue, clock):
+    enqueue(queue, "a")
+    for attempt in range(1, jobs.MAX_ATTEMPTS + 1):
+        job = queue.claim()
+        assert job["attempts"] == attempt
+        queue.fail(job, RuntimeError(f"attempt {attempt}"))
+        clock[0] += queue.backoff(attempt)
+    assert queue.claim() is None
+    assert queue.depth() == {"pending": 0, "running": 0, "failed": 1}
+
+
+def test_expired_lease_is_claimed_again(queue, clock):
+    enqueue(queue, "a")
+    queue.claim()
+    clock[0] += jobs.LEASE_SECONDS - 1
+    assert queue.claim() is None
+    clock[0] += 1
+    assert queue.claim()["attempts"] == 2
+
+
+def test_expired_lease_on_the_last_attempt_fails_the_job(queue, clock):
+    enqueue(queue, "a")
+    for _ in range(jobs.MAX_ATTEMPTS):
+        assert queue.claim() is not None
+        clock[0] += jobs.LEASE_SECONDS
+    assert queue.claim() is None
+    assert queue.depth() == {"pending": 0, "running": 0, "failed": 1}
+    with queue.connect() as conn:
+        row = conn.execute("select last_error from memory_jobs").fetchone()
+    assert row["last_error"] == f"lease expired on attempt {jobs.MAX_ATTEMPTS}"
@@ -0,0 +1,59 @@
+import pytest
+
+from backend import memory
+
+
+@pytest.fixture
+def upserts(monkeypatch):
+    existing = {"dog": ("fact_1", "User has a dog named Max.")}
+
+    def index_query(index, namespace, query, top_k):
+        for word, (id, text) in existing.items():
+            if word in query:
+                return [{"_id": id, "_score": 0.9, "fields": {"text": text}}]
+        return []
+
+    records = []
+    monkeypatch.setattr(memory, "index_query", index_query)
+    monkeypatch.setattr(
+        memory, "index_upsert", lambda index, namespace, new: records.extend(new)
+    )
+    return records
+
+
+def test_chunks_the_model_did_not_merge_are_kept(monkeypatch, upserts):
+    # the model merges one chunk and forgets to mention the other
+    monkeypatch.setattr(
+        memory,
+        "batch_merger",
+        lambda groups: {
+            "fact_1": {
+                "id": "fact_1",
+                "resolved_fact": "User has a golden retriever named Max.",
+                "merged_facts": ["0"],
+            }
+        },
+    )
+    memory.process_chunks_for_index(
+        "memories-user",
+        "u/p",
+        "m1",
+        [
+            "User's dog is a golden retriever.",
+            "User's dog loves the beach.",
+            "User likes tea.",
+        ],
+    )
+    assert {r["id"]: r["text"] for r in upserts} == {
+        "m1_0": "User likes tea.",
+        "fact_1": "User has a golden retriever named Max.",
+        "m1_1": "User's dog loves the beach.",
+    }
+
+
+def test_a_group_left_unresolved_becomes_new_facts(monkeypatch, upserts):
+    monkeypatch.setattr(memory, "batch_merger", lambda groups: {})
+    memory.process_chunks_for_index(
+        "memories-user", "u/p", "m1", ["User's dog is old.", "User's dog is deaf."]
+    )
+    assert [r["text"] for r in upserts] == ["User's dog is old.", "User's dog is deaf."]
@@ -0,0 +1,66 @@
+import time
+import asyncio
+
+import pytest
+
+from backend import outbox
+from backend.outbox import Outbox, DeliveryError
+
+
+@pytest.fixture(autouse=True)
+def quick_retries(monkeypatch):
+    monkeypatch.setattr(outbox, "RETRY_BACKOFF_SECONDS", 0.01)
+    monkeypatch.setattr(outbox, "_outboxes", [])
+
+
+def test_a_chat_keeps_its_order_while_a_send_is_retried():
+    sent, failures = [], {"a1": 2}
+
+    async def deliver(chat_id, message):
+        await asyncio.sleep(0.001)
+        if failures.get(message):
+            failures[message] -= 1
+            raise DeliveryError("busy")
+        sent.append(message)
+
+    async def main():
+        box = Outbox("telegram", deliver)
+        futures = [box.put("a", m) for m in ("a1", "a2", "a3")]
+        futures.append(box.put("b", "b1"))
+        return await asyncio.gather(*futures)
+
+    assert asyncio.run(main()) == [True, True, True, True]
+    assert [m for m in sent if m.startswith("a")] == ["a1", "a2", "a3"]
+    # other chats don't wait on a retrying one
+    assert sent.index("b1") < sent.index("a1")
+
+
+def test_retry_after_is_honoured():
+    attempts = []
+
+    async def deliver(chat_id, message):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise DeliveryError("429 too many requests", retry_after=0.2)
+
+    async def main():
+        return await Outbox("telegram", deliver).put("a", "hi")
+
+    assert asyncio.run(main())
+    assert attempts[1] - attempts[0] >= 0.2
+
+
+def test_a_refused_send_is_not_retried_and_the_queue_goes_on():
+    attempts = []
+
+    async def deliver(chat_id, message):
+        attempts.append(message)
+        if message == "bad":
+            raise DeliveryError("400 bad request", retryable=False)
+
+    async def main():
+        box = Outbox("telegram", deliver)
+        return await asyncio.gather(box.put("a", "bad"), box.put("a", "good"))
+
+    assert asyncio.run(main()) == [False, True]
+    assert attempts == ["bad", "good"]
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from backend import dbp, polling
+
+
+class Bot:
+    def __init__(self, updates):
+        self.updates, self.offsets = updates, []
+
+    def event_id(self, update):
+        return update["update_id"]
+
+    async def get_updates(self, offset=None, timeout=0, limit=100):
+        self.offsets.append(offset)
+        if len(self.offsets) > 3:
+            # nothing new, end the poll
+            raise asyncio.CancelledError
+        return [u for u in self.updates if offset is None or u["update_id"] >= offset]
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    stored, failures = {}, {"2": 1}
+
+    async def enqueue(channel, event_id, payload, lease_seconds):
+        if failures.get(event_id):
+            failures[event_id] -= 1
+            raise ConnectionError("database unavailable")
+        if (channel, event_id) in stored:
+            return False
+        stored[(channel, event_id)] = "running"
+        return True
+
+    async def update(channel, event_id, update):
+        stored[(channel, event_id)] = update["status"]
+
+    answered = []
+
+    async def respond(bot, channel, update):
+        answered.append(update["update_id"])
+
+    monkeypatch.setattr(dbp, "aenqueue_inbound_event", enqueue)
+    monkeypatch.setattr(dbp, "aupdate_inbound_event", update)
+    monkeypatch.setattr(polling, "respond", respond)
+    # retry a failed store at once
+    sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, "sleep", lambda delay: sleep(0))
+    return stored, answered
+
+
+def test_offset_only_moves_past_stored_updates(stored):
+    stored, answered = stored
+    bot = Bot([{"update_id": 1}, {"update_id": 2}, {"update_id": 3}])
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(polling.Poller(bot, workers=2).run())
+
+    # storing 2 failed, so the next poll started from it rather than past it
+    assert bot.offsets[:3] == [None, 2, 4]
+    assert sorted(answered) == [1, 2, 3]
+    assert set(stored.values()) == {"done"}
@@ -0,0 +1,101 @@
+import time
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from backend.utils import (
+    TOOL_MAPPING,
+    KeyedLock,
+    TokenBucket,
+    tool,
+    handle_tool_calls,
+)
+
+
+def tool_call(id, name):
+    return SimpleNamespace(id=id, function=SimpleNamespace(name=name, arguments="{}"))
+
+
+@pytest.fixture
+def slow_tool():
+    release = threading.Event()
+
+    @tool(timeout=0.2, concurrency=1)
+    def slow():
+        """Wait until released."""
+        release.wait(5)
+        return "done"
+
+    yield release
+    release.set()
+    del TOOL_MAPPING["slow"]
+    slow.executor.shutdown(wait=True)
+
+
+@pytest.fixture
+def quick_tool():
+    @tool(timeout=0.2, concurrency=1)
+    def quick():
+        """Sleep briefly."""
+        time.sleep(0.15)
+        return "done"
+
+    yield
+    del TOOL_MAPPING["quick"]
+    quick.executor.shutdown(wait=True)
+
+
+def test_timeout_starts_when_the_call_runs(quick_tool):
+    # two calls share one thread, the second waits 0.15s but still gets all 0.2s
+    results = asyncio.run(
+        handle_tool_calls("u", "p", [tool_call("1", "quick"), tool_call("2", "quick")])
+    )
+    assert [r["content"] for r in results] == ['"done"', '"done"']
+
+
+def test_a_stuck_tool_times_out_and_never_runs_queued_calls(slow_tool):
+    results = asyncio.run(
+        handle_tool_calls("u", "p", [tool_call("1", "slow"), tool_call("2", "slow")])
+    )
+    assert results[0]["content"] == "Error: slow timed out after 0.2 seconds"
+    assert results[1]["content"] == "Error: slow is busy, try again later"
+
+
+def test_unknown_tool_is_reported():
+    results = asyncio.run(handle_tool_calls("u", "p", [tool_call("1", "missing")]))
+    assert results[0]["content"].startswith("Error: ")
+
+
+def test_keyed_lock_serializes_a_key_but_not_others():
+    locks, events = KeyedLock(), []
+
+    async def hold(key, name):
+        async with locks.hold(key):
+            events.append(f"{name} in")
+            await asyncio.sleep(0.02)
+            events.append(f"{name} out")
+
+    async def main():
+        await asyncio.gather(hold("a", "a1"), hold("a", "a2"), hold("b", "b1"))
+
+    asyncio.run(main())
+    assert events.index("a1 out") < events.index("a2 in")
+    assert events.index("b1 in") < events.index("a1 out")
+    assert len(locks) == 0
+
+
+def test_token_bucket_lets_a_burst_through_then_paces():
+    async def main():
+        bucket, times = TokenBucket(rate=20, burst=2), []
+        start = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+            times.append(time.monotonic() - start)
+        return times
+
+    times = asyncio.run(main())
+    assert times[1] < 0.02
+    # the two after the burst wait a twentieth of a second each
+    assert times[3] >= 0.09